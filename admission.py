@@ -0,0 +1,128 @@
+import math
+from typing import Callable, Dict, Tuple
+
+from fastapi import HTTPException
+from starlette.responses import PlainTextResponse
+
+
+class AdmissionController:
+    """
+    Decides whether the server takes on another job. Jobs are refused with
+    429 and a Retry-After estimate when the queue already holds
+    `max_queue_depth` jobs, when their uploads would exceed
+    `max_bytes_in_flight` bytes of memory or when their rows would exceed
+    `max_queued_rows`. A job is always admitted into an empty queue, so
+    a single large job is never refused outright.
+    """
+
+    def __init__(
+        self,
+        max_bytes_in_flight: int,
+        max_queue_depth: int,
+        max_queued_rows: int,
+        rows_per_second: Callable[[], float],
+    ) -> None:
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.max_queued_rows = max_queued_rows
+        self._rows_per_second = rows_per_second
+        self._reserved: Dict[str, Tuple[int, int]] = {}
+        self.bytes_in_flight = 0
+        self.queued_rows = 0
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        """Seconds until the printers have worked through the queued rows."""
+        return max(1, math.ceil(self.queued_rows / max(self._rows_per_second(), 1.0)))
+
+    def check_depth(self) -> None:
+        """Cheap check before the upload is even looked at."""
+        if len(self._reserved) >= self.max_queue_depth:
+            self._reject("Too many jobs queued.")
+
+    def admit(self, job_id: str, nbytes: int, rows: int) -> None:
+        self.check_depth()
+        if self._reserved:
+            if self.bytes_in_flight + nbytes > self.max_bytes_in_flight:
+                self._reject("Too much image data waiting to be processed.")
+            if self.queued_rows + rows > self.max_queued_rows:
+                self._reject("Too many rows queued for printing.")
+        self._reserved[job_id] = (nbytes, rows)
+        self.bytes_in_flight += nbytes
+        self.queued_rows += rows
+
+    def update_rows(self, job_id: str, rows: int) -> None:
+        """Replaces a job's estimated rows with the encoded count."""
+        if job_id in self._reserved:
+            nbytes, estimated = self._reserved[job_id]
+            self._reserved[job_id] = (nbytes, rows)
+            self.queued_rows += rows - estimated
+
+    def release_bytes(self, job_id: str) -> None:
+        """Called once the job's upload has been decoded and freed."""
+        if job_id in self._reserved:
+            nbytes, rows = self._reserved[job_id]
+            self._reserved[job_id] = (0, rows)
+            self.bytes_in_flight -= nbytes
+
+    def release(self, job_id: str) -> None:
+        """Called when the job has finished or failed."""
+        nbytes, rows = self._reserved.pop(job_id, (0, 0))
+        self.bytes_in_flight -= nbytes
+        self.queued_rows -= rows
+
+    def _reject(self, reason: str) -> None:
+        self.rejected += 1
+        raise HTTPException(
+            status_code=429,
+            detail=f"{reason} Please retry later.",
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects request bodies larger than `max_bytes` with 413. A declared
+    Content-Length is checked before anything is read; otherwise the body
+    is counted as it streams in and the request is cut off at the limit,
+    so an oversized upload is never buffered in full. Whatever error the
+    application answers the truncated body with is replaced by the 413.
+    """
+
+    def __init__(self, app, max_bytes: int) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        too_large = PlainTextResponse(f"Upload larger than {self.max_bytes} bytes.", status_code=413)
+        for name, value in scope.get("headers", []):
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                await too_large(scope, receive, send)
+                return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def limited_send(message):
+            if not exceeded:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                await too_large(scope, receive, send)
+
+        await self.app(scope, limited_receive, limited_send)
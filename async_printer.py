@@ -0,0 +1,247 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+from flow_control import FlowController
+from printer import DEFAULT_CHUNK_SIZE, EndOfJobDetector, JobProgress, write_ranges
+from printer_connection import PrinterConnection
+from printer_data import EncodedJob, PrinterData, ROW_FRAME_SIZE
+from transmission_stats import TransmissionStats
+import utils
+
+# Seconds a cancelled job gets to finish its current frame and footer before
+# the link is dropped instead.
+CANCEL_CLOSE_TIMEOUT = 5.0
+
+
+class AsyncPrinter:
+    """
+    asyncio counterpart of Printer. The serial port's file descriptor is driven
+    with non-blocking reads and writes registered on the event loop, so a job
+    in progress never blocks other requests. Jobs sent to the same printer
+    are serialised; cancelling a job completes the frame being written and
+    closes the job off with the footer frames. The printer answers those
+    with an end-of-job response, which the next job reads before its own
+    header so it cannot be taken for the next job's.
+    """
+
+    def __init__(
+        self,
+        connection: PrinterConnection,
+        end_timeout: float = 120.0,
+        flow_control: Optional[FlowController] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_resumes: int = 3,
+    ) -> None:
+        self._connection = connection
+        self._end_timeout = end_timeout
+        self._flow = flow_control
+        self._chunk_size = chunk_size
+        self._max_resumes = max_resumes
+        self._detector = EndOfJobDetector()
+        self._lock = asyncio.Lock()
+        # Seconds from the first byte of the last job to its end-of-job response.
+        self.last_job_time: Optional[float] = None
+        self.jobs_completed = 0
+        self._progress: Optional[JobProgress] = None
+        self.resumes = 0
+        # Offset in the current job's buffer up to which bytes were written.
+        self._sent = 0
+        # A cancelled job's footer went out, but its end-of-job response
+        # has not been read yet.
+        self._end_pending = False
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    @property
+    def acknowledged_row(self) -> int:
+        """Last row of the current job known to have reached the printer."""
+        return self._progress.row if self._progress is not None else 0
+
+    async def run(self, mission: PrinterData, stats: Optional[TransmissionStats] = None) -> None:
+        """Sends one mission, returning once the printer reports it done."""
+        started = time.monotonic()
+        for job in mission.encode_segments():
+            await self.send(job, stats)
+        self.last_job_time = time.monotonic() - started
+
+    async def send(self, job: EncodedJob, stats: Optional[TransmissionStats] = None) -> None:
+        """
+        Writes an encoded job and waits for its end-of-job response. Like
+        Printer.send, a dropped link is reopened and the job resumes from the
+        last acknowledged row, up to `max_resumes` times.
+        """
+        async with self._lock:
+            started = time.monotonic()
+            if stats is not None:
+                stats.on_job_start(job.rows)
+
+            progress = self._progress = JobProgress(job, self._max_resumes)
+            while True:
+                try:
+                    await self._send_from(job, progress.row, stats)
+                    break
+                except utils.PrinterDisconnectedException as e:
+                    if not progress.resume(e):
+                        raise
+                    self.resumes += 1
+
+            if stats is not None:
+                stats.on_end_response()
+            self.last_job_time = time.monotonic() - started
+            self.jobs_completed += 1
+            if self._flow is not None:
+                self._flow.on_job_end(job.rows, self.last_job_time)
+
+    async def _open(self) -> int:
+        # Opening may back off and retry, so keep it off the event loop.
+        serial = await asyncio.to_thread(self._connection.connect)
+        fd = serial.fileno()
+        os.set_blocking(fd, False)
+        return fd
+
+    async def _send_from(self, job: EncodedJob, start_row: int, stats: Optional[TransmissionStats]) -> None:
+        fd = await self._open()
+        if self._end_pending:
+            fd = await self._read_pending_end(fd)
+        self._connection.reset_input_buffer()
+        self._detector.reset()
+        self._sent = 0
+
+        try:
+            await self._send_frames(fd, job, start_row, stats)
+        except asyncio.CancelledError:
+            await self._close_cancelled(fd, job)
+            raise
+
+        try:
+            await asyncio.wait_for(self._wait_for_end(fd), self._end_timeout)
+        except asyncio.TimeoutError:
+            raise utils.PrintTimeoutException(self._end_timeout) from None
+        except asyncio.CancelledError:
+            self._end_pending = True
+            raise
+
+    async def _read_pending_end(self, fd: int) -> int:
+        """
+        Reads the end-of-job response of a cancelled job, which the printer
+        sends once it has printed the rows it already had. If it does not
+        arrive within `end_timeout` the link is reopened instead. Returns
+        the file descriptor to go on with.
+        """
+        try:
+            await asyncio.wait_for(self._wait_for_end(fd), self._end_timeout)
+        except asyncio.TimeoutError:
+            self._connection.drop(TimeoutError("no end-of-job response for a cancelled job"))
+            self._end_pending = False
+            return await self._open()
+        except utils.PrinterDisconnectedException:
+            # The response went with the link.
+            self._end_pending = False
+            raise
+        self._end_pending = False
+        return fd
+
+    async def _send_frames(self, fd: int, job: EncodedJob, start_row: int, stats: Optional[TransmissionStats]) -> None:
+        if self._flow is not None:
+            self._flow.start()
+        for start, end, rows in write_ranges(job, start_row, self._chunk_size, self._flow):
+            if rows:
+                delay = self._flow.reserve(rows)
+                if delay:
+                    await asyncio.sleep(delay)
+            latency = await self._write(fd, job, start, end, stats)
+            if rows:
+                self._flow.on_write(latency, rows)
+
+    async def _close_cancelled(self, fd: int, job: EncodedJob) -> None:
+        """
+        Closes a cancelled job so the printer is not left waiting for rows.
+        Cancellation can land in the middle of a frame, so that frame is
+        completed before the footer. If this does not finish within
+        CANCEL_CLOSE_TIMEOUT the link is dropped, and the next job reopens it.
+        Otherwise the next job first reads the response to the footer.
+        """
+        sent = self._sent
+        if not sent:
+            return
+        footer_start = job.row_offset(job.rows)
+        if sent >= footer_start:
+            tail = memoryview(job.buffer)[sent:]
+        else:
+            if sent <= job.HEADER_SIZE:
+                frame_end = job.HEADER_SIZE
+            else:
+                frame_end = job.row_offset(-(-(sent - job.HEADER_SIZE) // ROW_FRAME_SIZE))
+            tail = bytes(memoryview(job.buffer)[sent:frame_end]) + job.footer()
+        try:
+            await asyncio.wait_for(self._write_all(fd, tail), CANCEL_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._connection.drop(TimeoutError("cancelled job could not be closed"))
+        except utils.PrinterDisconnectedException:
+            pass
+        else:
+            self._end_pending = True
+
+    async def _write(
+        self, fd: int, job: EncodedJob, start: int, end: int, stats: Optional[TransmissionStats]
+    ) -> float:
+        """
+        Writes bytes `start` to `end` of the job buffer, advances the
+        acknowledged row and returns how long it took, waits included.
+        """
+        write_started = time.monotonic()
+        self._sent = start
+        await self._write_all(fd, memoryview(job.buffer)[start:end])
+        latency = time.monotonic() - write_started
+        rows_sent = job.rows_before(end)
+        if stats is not None:
+            stats.on_write(end - start, latency, rows_sent)
+        in_flight = self._flow.in_flight if self._flow is not None else 0
+        self._progress.on_write(end, self._connection.out_waiting(), in_flight)
+        return latency
+
+    async def _write_all(self, fd: int, view) -> None:
+        """Writes `view` in full, advancing `_sent` as the bytes go out."""
+        view = memoryview(view)
+        loop = asyncio.get_running_loop()
+        while view:
+            try:
+                written = os.write(fd, view)
+            except BlockingIOError:
+                await self._wait_fd(loop.add_writer, loop.remove_writer, fd)
+                continue
+            except OSError as e:
+                self._connection.drop(e)
+                raise utils.PrinterDisconnectedException(self._connection.port, str(e)) from e
+            view = view[written:]
+            self._sent += written
+
+    async def _wait_for_end(self, fd: int) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wait_fd(loop.add_reader, loop.remove_reader, fd)
+            try:
+                data = os.read(fd, 4096)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                self._connection.drop(e)
+                raise utils.PrinterDisconnectedException(self._connection.port, str(e)) from e
+            if not data:
+                self._connection.drop(EOFError("link closed"))
+                raise utils.PrinterDisconnectedException(self._connection.port, "link closed")
+            if self._detector.feed(data):
+                return
+
+    @staticmethod
+    async def _wait_fd(add, remove, fd: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        add(fd, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            remove(fd)
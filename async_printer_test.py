@@ -0,0 +1,29 @@
+import asyncio
+import time
+
+from async_printer import AsyncPrinter
+from fake_printer import FakePrinter
+from printer_connection import PrinterConnection
+from printer_data import PrinterData
+
+
+def test_cancelled_job_response_does_not_end_next_job():
+    cancelled = PrinterData.from_packets([bytes(48)] * 1000).encode()
+    job = PrinterData.from_packets([bytes(48)] * 400).encode()
+
+    async def run(port):
+        connection = PrinterConnection(port)
+        printer = AsyncPrinter(connection, end_timeout=10)
+        task = asyncio.create_task(printer.send(cancelled))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await printer.send(job)
+        connection.close()
+
+    with FakePrinter(rows_per_second=2000, buffer_rows=256) as printer:
+        asyncio.run(run(printer.port))
+        # The second job only counts as done once the emulator finished it.
+        assert printer.jobs_completed == 2
+        assert printer.rows_printed >= job.rows
+        assert printer.errors == []
@@ -0,0 +1,33 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class RecentSubmissions:
+    """
+    Remembers which job each submission key created during the last
+    `window` seconds, so a retried request can be answered with the job it
+    already created instead of printing twice.
+    """
+
+    def __init__(self, window: float = 600.0) -> None:
+        self.window = window
+        self._jobs: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        self._expire()
+        entry = self._jobs.get(key)
+        return entry[0] if entry else None
+
+    def add(self, key: str, job_id: str) -> None:
+        self._jobs.pop(key, None)
+        self._jobs[key] = (job_id, time.monotonic() + self.window)
+
+    def _expire(self) -> None:
+        # Entries are kept in insertion order, which is also expiry order.
+        now = time.monotonic()
+        while self._jobs:
+            key, (_, expires) = next(iter(self._jobs.items()))
+            if expires > now:
+                break
+            del self._jobs[key]
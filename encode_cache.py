@@ -0,0 +1,63 @@
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional
+
+from printer_data import EncodedJob
+
+
+def cache_key(kind: str, content, **options) -> str:
+    """
+    Hash of what was encoded (any bytes-like object) and every option that
+    changes the result.
+    """
+    digest = hashlib.sha256()
+    digest.update(kind.encode())
+    for name in sorted(options):
+        digest.update(f"\0{name}={options[name]!r}".encode())
+    digest.update(b"\0")
+    digest.update(content)
+    return digest.hexdigest()
+
+
+class EncodedJobCache:
+    """
+    Least recently used cache of encoded jobs, bounded by the total size of
+    their buffers. Encoded jobs are never modified after encoding, so a
+    cached entry can be sent any number of times, also concurrently.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, List[EncodedJob]]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[EncodedJob]]:
+        jobs = self._entries.get(key)
+        if jobs is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return jobs
+
+    def put(self, key: str, jobs: List[EncodedJob]) -> None:
+        nbytes = sum(len(job) for job in jobs)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= sum(len(job) for job in self._entries.pop(key))
+        self._entries[key] = jobs
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= sum(len(job) for job in evicted)
+
+    def status(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
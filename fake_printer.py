@@ -0,0 +1,223 @@
+import argparse
+import os
+import queue
+import threading
+import time
+import tty
+from typing import List, Optional
+
+from printer import PRINT_END_RESPONSE
+from printer_data import JOB_HEADER, ROW_FRAME_PREFIX
+
+# Commands carried in the fourth byte of a frame.
+CMD_CONTROL = 0x01
+CMD_START = 0x02
+CMD_ROW = 0x03
+
+_END_OF_JOB = object()
+
+
+class FrameParser:
+    """
+    Splits the byte stream sent to the printer into frames of the form
+    AA AA <length> <command> <payload> 55 55, where the length counts the
+    command byte and the payload. Data that does not form a valid frame is
+    reported and skipped up to the next sync bytes.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self.errors: List[str] = []
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self._buffer += data
+        frames = []
+        while True:
+            start = self._buffer.find(b'\xaa\xaa')
+            if start == -1:
+                # Keep a lone trailing AA, it may start the next frame.
+                kept = 1 if self._buffer.endswith(b'\xaa') else 0
+                if len(self._buffer) > kept:
+                    self.errors.append(f"discarded {len(self._buffer) - kept} bytes outside any frame")
+                del self._buffer[:len(self._buffer) - kept]
+                return frames
+            if start:
+                self.errors.append(f"discarded {start} bytes outside any frame")
+                del self._buffer[:start]
+            if len(self._buffer) < 3:
+                return frames
+            size = 3 + self._buffer[2] + 2
+            if len(self._buffer) < size:
+                return frames
+            frame = bytes(self._buffer[:size])
+            if not frame.endswith(b'UU'):
+                self.errors.append(f"frame without UU trailer: {frame[:8].hex()}")
+                del self._buffer[:2]
+                continue
+            del self._buffer[:size]
+            frames.append(frame)
+
+
+class FakePrinter:
+    """
+    Emulates a WP9516 on a pseudo-terminal, so Printer, AsyncPrinter and the
+    server can be driven end to end without the hardware. The emulator checks
+    the job header, that row indices count up without gaps (from zero, or
+    from the resume row after a link drop) and that every frame ends with UU.
+    Rows go through a buffer of `buffer_rows` rows which the simulated head
+    drains at `rows_per_second`; while it is full the emulator stops reading,
+    so the sender sees the same backpressure as from a real printer.
+    PRINT_END_RESPONSE is sent once the last row of a job has been printed.
+    """
+
+    def __init__(self, rows_per_second: float = 400.0, buffer_rows: int = 512) -> None:
+        self.rows_per_second = rows_per_second
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._parser = FrameParser()
+        self._rows = queue.Queue(maxsize=buffer_rows)
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._header: List[bytes] = []
+        self._next_row: Optional[int] = None
+        # First control frame after the rows, until the next frame shows
+        # whether it starts the footer or a new header.
+        self._closing: Optional[bytes] = None
+        self.bytes_received = 0
+        self.rows_received = 0
+        self.rows_printed = 0
+        self.jobs_completed = 0
+        self.resumed_jobs = 0
+        self._errors: List[str] = []
+
+    @property
+    def errors(self) -> List[str]:
+        return self._errors + self._parser.errors
+
+    def start(self) -> 'FakePrinter':
+        for target in (self._receive, self._print):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        os.close(self._slave)
+        os.close(self._master)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _receive(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self.bytes_received += len(data)
+            for frame in self._parser.feed(data):
+                self._handle(frame)
+
+    def _handle(self, frame: bytes) -> None:
+        command = frame[3]
+        if self._closing is not None:
+            closing, self._closing = self._closing, None
+            if command == CMD_CONTROL:
+                # Two control frames after the rows are the footer.
+                self._next_row = None
+                self._rows.put(_END_OF_JOB)
+                return
+            # Anything else means a new header started before the footer,
+            # as happens when a sender resumes after a link drop.
+            self._next_row = None
+            self._header = [closing]
+
+        if command == CMD_ROW:
+            if self._next_row is None:
+                self._errors.append("row frame outside a job")
+                return
+            if not frame.startswith(ROW_FRAME_PREFIX) or frame[6] != 1:
+                self._errors.append(f"malformed row frame: {frame[:8].hex()}")
+                return
+            row = frame[4] | (frame[5] << 8)
+            if self._next_row == 0 and row:
+                # A sender resuming after a link drop restarts mid-job.
+                self.resumed_jobs += 1
+            elif row != self._next_row:
+                self._errors.append(f"expected row {self._next_row}, got {row}")
+            self._next_row = row + 1
+            self.rows_received += 1
+            # Blocks while the buffer is full, which stops reading the pty.
+            self._rows.put(frame[7:-2])
+        elif command == CMD_START:
+            self._header.append(frame)
+            # Footer frames of the previous job may precede the header.
+            if tuple(self._header[-len(JOB_HEADER):]) != JOB_HEADER:
+                self._errors.append(f"unexpected job header: {[f.hex() for f in self._header]}")
+            self._header = []
+            self._next_row = 0
+        elif command == CMD_CONTROL and self._next_row is not None:
+            self._closing = frame
+        else:
+            self._header.append(frame)
+
+    def _print(self) -> None:
+        interval = 1.0 / self.rows_per_second
+        next_row_at = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                item = self._rows.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END_OF_JOB:
+                self.jobs_completed += 1
+                try:
+                    os.write(self._master, PRINT_END_RESPONSE)
+                except OSError:
+                    return
+                continue
+            now = time.monotonic()
+            next_row_at = max(next_row_at + interval, now)
+            if next_row_at > now:
+                time.sleep(next_row_at - now)
+            self.rows_printed += 1
+
+    def status(self) -> dict:
+        return {
+            "port": self.port,
+            "bytes_received": self.bytes_received,
+            "rows_received": self.rows_received,
+            "rows_printed": self.rows_printed,
+            "jobs_completed": self.jobs_completed,
+            "resumed_jobs": self.resumed_jobs,
+            "errors": self.errors,
+        }
+
+
+def main():
+    """
+    Runs the emulator until interrupted. Point a Printer, the CLI or the
+    server at the printed port.
+    """
+    parser = argparse.ArgumentParser(description="Emulate a WP9516 printer on a pseudo-terminal.")
+    parser.add_argument("--rows-per-second", type=float, default=400.0, help="simulated print head speed")
+    parser.add_argument("--buffer-rows", type=int, default=512, help="rows the printer buffers before pushing back")
+    args = parser.parse_args()
+
+    with FakePrinter(args.rows_per_second, args.buffer_rows) as printer:
+        print(f"Fake printer listening on {printer.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        print(printer.status())
+
+
+if __name__ == "__main__":
+    main()
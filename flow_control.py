@@ -0,0 +1,124 @@
+import time
+from typing import Optional
+
+# Initial head speed estimate in rows per second. The estimate only limits
+# how fast credits come back, so starting near what the link carries and
+# letting stalls pull it down costs little, while starting too low holds
+# every job back until the estimate has crept up.
+DEFAULT_ROWS_PER_SECOND = 4000.0
+
+
+class FlowController:
+    """
+    Credit-based flow control for row frames.
+
+    The printer head drains rows far slower than the link delivers them, so
+    the sender may only keep `window` rows in flight. Credits come back at the
+    estimated head speed (`rows_per_second`). The window grows by one row for
+    every full window written without a stall and halves when a write blocks,
+    since a blocking write means the printer's buffer is full and the link is
+    pushing back.
+
+    A write that does not block only shows that the driver took the bytes,
+    not how fast the head prints, so the head speed estimate is only raised
+    from the time the printer takes to report the end of each job. A job
+    that stalled kept the head busy, and its rows per second become the
+    estimate. A job that finished as fast as the estimate allowed without a
+    stall probes the estimate upwards by `probe`, since the throttled send
+    rate then hides the real head speed. Within a job the estimate steps
+    back by `probe` on each stall and recovers on clean windows, but never
+    beyond the estimate the last job ended with.
+    """
+
+    def __init__(
+        self,
+        window: int = 128,
+        min_window: int = 8,
+        max_window: int = 2048,
+        rows_per_second: float = DEFAULT_ROWS_PER_SECOND,
+        max_rows_per_second: float = 20000.0,
+        stall_threshold: float = 0.02,
+        smoothing: float = 0.3,
+        probe: float = 0.1,
+    ) -> None:
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.rows_per_second = rows_per_second
+        # The estimate as of the end of the last job, or as configured.
+        self.measured_rows_per_second = rows_per_second
+        self.max_rows_per_second = max_rows_per_second
+        self.stall_threshold = stall_threshold
+        self._smoothing = smoothing
+        self._probe = probe
+        self._in_flight = 0.0
+        self._last_drain: Optional[float] = None
+        self._clean_rows = 0
+        self._job_stalls = 0
+        self.stalls = 0
+
+    def start(self) -> None:
+        """Resets the in-flight count at the start of a job."""
+        self._in_flight = 0.0
+        self._last_drain = time.monotonic()
+        self._clean_rows = 0
+        self._job_stalls = 0
+
+    def _drain(self) -> None:
+        now = time.monotonic()
+        if self._last_drain is not None:
+            self._in_flight = max(0.0, self._in_flight - (now - self._last_drain) * self.rows_per_second)
+        self._last_drain = now
+
+    @property
+    def in_flight(self) -> float:
+        """Rows sent but estimated not yet printed."""
+        self._drain()
+        return self._in_flight
+
+    def reserve(self, rows: int = 1) -> float:
+        """
+        Takes `rows` credits and returns how many seconds the sender has to
+        wait before writing them, so both blocking and asyncio senders can
+        share one controller.
+        """
+        self._drain()
+        excess = self._in_flight + rows - self.window
+        self._in_flight += rows
+        return max(0.0, excess) / self.rows_per_second
+
+    def acquire(self, rows: int = 1) -> None:
+        """Blocks until `rows` more rows fit in the window, then takes them."""
+        delay = self.reserve(rows)
+        if delay:
+            time.sleep(delay)
+
+    def on_write(self, latency: float, rows: int = 1) -> None:
+        """Adapts the window from how long writing `rows` rows took."""
+        if latency > self.stall_threshold:
+            self.stalls += 1
+            self._job_stalls += 1
+            self.window = max(self.min_window, self.window // 2)
+            self.rows_per_second /= 1 + self._probe
+            self._clean_rows = 0
+            return
+
+        self._clean_rows += rows
+        if self._clean_rows >= self.window:
+            self._clean_rows = 0
+            self.window = min(self.max_window, self.window + 1)
+            self.rows_per_second = min(self.measured_rows_per_second, self.rows_per_second * (1 + self._probe))
+
+    def on_job_end(self, rows: int, elapsed: float) -> None:
+        """Refines the head speed from a job's measured completion time."""
+        if rows <= 0 or elapsed <= 0:
+            return
+        measured = rows / elapsed
+        if self._job_stalls:
+            self.rows_per_second = measured
+        elif measured >= (1 - self._probe / 2) * self.measured_rows_per_second:
+            self.rows_per_second = min(self.max_rows_per_second, self.measured_rows_per_second * (1 + self._probe))
+        else:
+            self.rows_per_second += self._smoothing * (measured - self.rows_per_second)
+        self.measured_rows_per_second = self.rows_per_second
+        self._in_flight = 0.0
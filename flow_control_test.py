@@ -0,0 +1,86 @@
+import pytest
+
+from fake_printer import FakePrinter
+from flow_control import FlowController
+from printer import Printer
+from printer_data import PrinterData
+
+
+def test_clean_window_grows_window_without_raising_rate():
+    flow = FlowController(window=16, rows_per_second=1000.0, probe=0.1)
+    flow.start()
+    flow.on_write(0.0, 8)
+    assert (flow.window, flow.rows_per_second) == (16, 1000.0)
+    flow.on_write(0.0, 8)
+    assert flow.window == 17
+    # Writes that do not block say nothing about the head speed.
+    assert flow.rows_per_second == 1000.0
+
+
+def test_stall_halves_window_and_backs_off_rate():
+    flow = FlowController(window=64, min_window=8, rows_per_second=1100.0, probe=0.1, stall_threshold=0.02)
+    flow.start()
+    flow.on_write(0.05, 8)
+    assert flow.window == 32
+    assert flow.rows_per_second == pytest.approx(1000.0)
+    assert flow.stalls == 1
+    for _ in range(5):
+        flow.on_write(0.05, 8)
+    assert flow.window == 8
+
+
+def test_rate_recovers_within_job_up_to_last_measured():
+    flow = FlowController(window=8, rows_per_second=1000.0, probe=0.1)
+    flow.start()
+    flow.on_write(0.05, 8)
+    for _ in range(20):
+        flow.on_write(0.0, 8)
+    assert flow.rows_per_second == 1000.0
+
+
+def test_job_end_probes_after_clean_job():
+    flow = FlowController(window=8, rows_per_second=1000.0, probe=0.1)
+    flow.start()
+    flow.on_job_end(1000, 1.0)
+    assert flow.rows_per_second == pytest.approx(1100.0)
+
+
+def test_job_end_probe_is_capped_by_link_rate():
+    flow = FlowController(window=8, rows_per_second=19000.0, max_rows_per_second=20000.0, probe=0.1)
+    flow.start()
+    flow.on_job_end(19000, 1.0)
+    assert flow.rows_per_second == 20000.0
+
+
+def test_job_end_takes_measured_rate_after_stall():
+    flow = FlowController(window=8, rows_per_second=4000.0)
+    flow.start()
+    flow.on_write(1.0, 8)
+    flow.on_job_end(400, 1.0)
+    assert flow.rows_per_second == pytest.approx(400.0)
+    assert flow.measured_rows_per_second == pytest.approx(400.0)
+
+
+def test_job_end_smooths_towards_slower_clean_job():
+    flow = FlowController(window=8, rows_per_second=1000.0, smoothing=0.5)
+    flow.start()
+    flow.on_job_end(400, 1.0)
+    assert flow.rows_per_second == pytest.approx(700.0)
+
+
+def test_reserve_waits_for_credits_beyond_window():
+    flow = FlowController(window=10, rows_per_second=100.0)
+    flow.start()
+    assert flow.reserve(10) == 0.0
+    assert flow.reserve(5) == pytest.approx(0.05, abs=0.01)
+
+
+def test_estimate_converges_to_emulated_head_speed():
+    job = PrinterData.from_packets([bytes(48)] * 1000).encode()
+    with FakePrinter(rows_per_second=2000, buffer_rows=64) as printer:
+        flow = FlowController()
+        sender = Printer(printer.port, flow_control=flow, end_timeout=10)
+        for _ in range(3):
+            sender.send(job)
+        assert printer.errors == []
+    assert flow.rows_per_second == pytest.approx(2000, rel=0.15)
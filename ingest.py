@@ -0,0 +1,209 @@
+import io
+import mmap
+import os
+import string
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from encode_cache import cache_key
+from printer_data import EncodedJob, encode_packets, fit_width, load_font, prepare_image, render_text
+from process_image_to_packets import iter_image_packets
+
+
+# 当前线程正在记录的各阶段耗时，见 timed()
+_stage_timings = threading.local()
+
+
+@contextmanager
+def _stage(name: str):
+    """
+    记录一个处理阶段（decode、resize、render、dither、framing）的耗时。
+    不在 timed() 中调用时只多一次计时，几乎没有开销。
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - started)
+
+
+def _record(name: str, seconds: float) -> None:
+    timings = getattr(_stage_timings, "current", None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def timed(function: Callable, *args) -> Tuple[object, Dict[str, float]]:
+    """
+    调用 function(*args)，同时返回其中各处理阶段的耗时（秒）。
+    它是模块级函数，可以整体提交给进程池，耗时随结果一起传回。
+    """
+    _stage_timings.current = {}
+    try:
+        return function(*args), _stage_timings.current
+    finally:
+        _stage_timings.current = None
+
+
+@contextmanager
+def _map_upload(file):
+    """
+    不复制地取得上传临时文件的内容。
+    Starlette 把较小的上传保存在内存中（BytesIO），用 getbuffer() 取得视图；
+    较大的上传已经写入磁盘，用 mmap 映射。
+    """
+    file.seek(0, os.SEEK_END)
+    if file.tell() == 0:
+        raise ValueError("The uploaded file is empty.")
+    spooled = getattr(file, "_file", file)
+    if isinstance(spooled, io.BytesIO):
+        buffer = spooled.getbuffer()
+    else:
+        buffer = mmap.mmap(spooled.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield buffer
+    finally:
+        if isinstance(buffer, memoryview):
+            buffer.release()
+        else:
+            buffer.close()
+
+
+def upload_key(file, **options) -> str:
+    """
+    上传内容和编码选项的哈希，用作编码缓存和去重的键。
+    """
+    with _map_upload(file) as buffer:
+        return cache_key("image", buffer, **options)
+
+
+def decode_upload(file) -> np.ndarray:
+    """
+    直接从上传的临时文件解码图片，并旋转缩放到打印机的384像素宽。
+    上传内容不会被复制一份；全尺寸的解码结果在缩放后立即释放，
+    只返回缩放后的图像。
+    """
+    with _map_upload(file) as buffer, _stage("decode"):
+        np_array = np.frombuffer(buffer, np.uint8)
+        image = cv2.imdecode(np_array, cv2.IMREAD_GRAYSCALE)
+        # 视图必须先于缓冲区释放
+        del np_array
+    if image is None:
+        raise ValueError("Could not decode the image. The file may be corrupt or in an unsupported format.")
+    with _stage("resize"):
+        return prepare_image(image)
+
+
+def prepared_rows(image: np.ndarray) -> int:
+    """
+    已缩放图像的打印行数，包括底部32行空白。
+    """
+    return image.shape[0] + 32
+
+
+def encode_image(image: np.ndarray, dithering: bool = True) -> List[EncodedJob]:
+    """
+    把已经旋转缩放过的图像抖动并编码成可直接发送的任务。
+    这是纯CPU工作，服务器在进程池中调用它，因此它必须是模块级函数，
+    返回值也只包含便于跨进程传递的连续缓冲区。
+    抖动好的行直接写入任务缓冲区，不先收集成完整的数据包列表。
+    """
+    dither = 0.0
+
+    def rows():
+        # 抖动和组帧交替进行，分别累计产生每一行和组帧所用的时间
+        nonlocal dither
+        packets = iter_image_packets(image, dithering=dithering)
+        while True:
+            started = time.perf_counter()
+            packet = next(packets, None)
+            dither += time.perf_counter() - started
+            if packet is None:
+                return
+            yield packet
+
+    started = time.perf_counter()
+    jobs = list(encode_packets(rows()))
+    _record("dither", dither)
+    _record("framing", time.perf_counter() - started - dither)
+    return jobs
+
+
+def encode_text(text: str, dithering: bool = False) -> List[EncodedJob]:
+    """
+    把文字渲染并编码成任务。文字按384像素宽换行（含左右各10像素边距），
+    渲染结果补白到正好384像素宽后直接编码，不旋转也不缩放，
+    所以一行小票只有几十行点阵，而不是像 PrinterData.from_string 那样
+    被转成竖向并放大到几千行。
+    字体在每个进程中只加载一次；文字本身是黑白的，默认不做抖动，
+    这样走的是向量化的二值化路径，短文本只需几毫秒。
+    """
+    with _stage("render"):
+        image = fit_width(render_text(text, max_width=384 - 20))
+    return encode_image(image, dithering=dithering)
+
+
+def render_preview(encoded: List[EncodedJob]) -> bytes:
+    """
+    把编码好的任务还原成打印机实际打印的1位图像，返回PNG。
+    预览直接来自将要发送的数据行，与打印结果逐点一致。
+    """
+    bits = np.unpackbits(np.concatenate([job.bitplane() for job in encoded]), axis=1)
+    # 置位的比特是黑点
+    ok, png = cv2.imencode(".png", (1 - bits) * 255)
+    if not ok:
+        raise ValueError("Could not encode the preview image.")
+    return png.tobytes()
+
+
+def warmup() -> Dict[str, float]:
+    """
+    预热当前进程，让第一个任务不必承担一次性的初始化开销：
+    加载字体并渲染所有可打印ASCII字符，载入OpenCV的PNG、JPEG和BMP编解码器，
+    再用一小块图像分别走一遍两种二值化方式（Floyd-Steinberg抖动和直接阈值）。
+    点阵字库 CHAR_BITMAPS 在导入 printer_data 时已经载入。
+    服务器启动时在主进程和每个编码进程中调用它，返回各阶段耗时（秒）。
+    """
+    def run() -> None:
+        with _stage("fonts"):
+            load_font()
+            render_text(string.ascii_letters + string.digits + string.punctuation)
+        sample = np.full((8, 384), 255, np.uint8)
+        with _stage("codecs"):
+            for extension in (".png", ".jpg", ".bmp"):
+                ok, data = cv2.imencode(extension, sample)
+                cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+        with _stage("resize"):
+            prepare_image(sample[:, :16])
+        for dithering in (True, False):
+            encode_image(sample, dithering=dithering)
+
+    return timed(run)[1]
+
+
+# 编码进程自己的预热失败原因，见 warmup_worker()
+_worker_warmup_error = None
+
+
+def warmup_worker() -> None:
+    """
+    编码进程池的 initializer，在每个编码进程启动时预热它。
+    initializer 抛出异常会使整个进程池失效，而没有预热的进程仍然可以正常编码，
+    所以失败时只记录原因，由 worker_warmup_error() 报告给主进程。
+    """
+    global _worker_warmup_error
+    try:
+        warmup()
+    except Exception as e:
+        _worker_warmup_error = f"{type(e).__name__}: {e}"
+        print(f"Encode worker {os.getpid()} warmup failed: {_worker_warmup_error}")
+
+
+def worker_warmup_error():
+    """在编码进程中执行，返回该进程预热失败的原因，成功时返回 None。"""
+    return _worker_warmup_error
@@ -0,0 +1,207 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from printer_data import EncodedJob
+from scheduler import JobScheduler, Priority
+
+
+class JobState(str, Enum):
+    QUEUED = "queued"
+    ENCODING = "encoding"
+    SENDING = "sending"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class PrintJob:
+    """
+    One submitted print job and its progress. Every state change records how
+    long the job spent in the previous state, so clients can see where the
+    time went.
+    """
+
+    def __init__(
+        self,
+        payload: Any = None,
+        priority: Priority = Priority.NORMAL,
+        client: str = "",
+        estimated_rows: Optional[int] = None,
+        **options,
+    ) -> None:
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.priority = priority
+        self.client = client
+        self.estimated_rows = estimated_rows
+        self.options = options
+        self.state = JobState.QUEUED
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.encoded: Optional[List[EncodedJob]] = None
+        self.rows: Optional[int] = None
+        self.port: Optional[str] = None
+        self.transmission: Optional[dict] = None
+        # The transport's live TransmissionStats while the job is sending.
+        self.stats = None
+        # Per-item status of a batch job, None for single jobs.
+        self.items: Optional[List[dict]] = None
+        self.timings: Dict[str, float] = {}
+        self._stage = "queue_wait"
+        self._stage_started = time.monotonic()
+        self.finished = asyncio.Event()
+
+    @property
+    def cost(self) -> int:
+        """Rows to print, estimated until the job has been encoded."""
+        if self.rows is not None:
+            return self.rows
+        return self.estimated_rows or 0
+
+    def _enter(self, stage: str, state: JobState) -> None:
+        now = time.monotonic()
+        self.timings[self._stage] = self.timings.get(self._stage, 0.0) + now - self._stage_started
+        self._stage = stage
+        self._stage_started = now
+        self.state = state
+
+    def start_encoding(self) -> None:
+        self._enter("encoding", JobState.ENCODING)
+
+    def wait_for_printer(self) -> None:
+        # Encoded, waiting for a printer: queued again until sending starts.
+        self._enter("send_wait", JobState.QUEUED)
+
+    def start_sending(self) -> None:
+        self._enter("sending", JobState.SENDING)
+
+    def finish(self) -> None:
+        self._enter("done", JobState.DONE)
+        self.finished.set()
+
+    def fail(self, error: Exception) -> None:
+        self.error = str(error) or type(error).__name__
+        self._enter("failed", JobState.FAILED)
+        self.finished.set()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "state": self.state.value,
+            "error": self.error,
+            "priority": self.priority.name.lower(),
+            "client": self.client,
+            "created_at": self.created_at,
+            "rows": self.rows,
+            "estimated_rows": self.estimated_rows,
+            "port": self.port,
+            "timings": dict(self.timings),
+            "transmission": self.transmission,
+            "items": self.items,
+        }
+
+
+class JobQueue:
+    """
+    Drains submitted jobs in two stages: `encode_workers` tasks run `encode`
+    on queued jobs, and `send_workers` tasks (one per printer is enough)
+    run `send` on encoded ones, so encoding later jobs overlaps printing
+    earlier ones. Both stages take jobs in JobScheduler order. The last
+    `history` finished jobs stay available for status queries, and
+    `on_finished` is called with every job that is done or failed.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[PrintJob], Awaitable[None]],
+        send: Callable[[PrintJob], Awaitable[None]],
+        encode_workers: int = 1,
+        send_workers: int = 1,
+        history: int = 1000,
+        on_finished: Optional[Callable[[PrintJob], None]] = None,
+    ) -> None:
+        self._encode = encode
+        self._send = send
+        self._on_finished = on_finished
+        self._encode_workers = encode_workers
+        self._send_workers = send_workers
+        self._history = history
+        self._jobs: "OrderedDict[str, PrintJob]" = OrderedDict()
+        self._to_encode = JobScheduler()
+        self._to_send = JobScheduler()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._encode_loop()) for _ in range(self._encode_workers)]
+        self._tasks += [asyncio.create_task(self._send_loop()) for _ in range(self._send_workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job: PrintJob) -> PrintJob:
+        self._jobs[job.id] = job
+        self._forget_old_jobs()
+        self._to_encode.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[PrintJob]:
+        return self._jobs.get(job_id)
+
+    @property
+    def depth(self) -> int:
+        """Jobs submitted but not yet sending."""
+        return self._to_encode.qsize() + self._to_send.qsize()
+
+    def _forget_old_jobs(self) -> None:
+        excess = len(self._jobs) - self._history
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished.is_set()][:excess]:
+            del self._jobs[job_id]
+
+    async def _encode_loop(self) -> None:
+        while True:
+            job = await self._to_encode.get()
+            try:
+                job.start_encoding()
+                await self._encode(job)
+                job.wait_for_printer()
+                self._to_send.put_nowait(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Job {job.id} failed while encoding: {e}")
+                job.fail(e)
+                self._finished(job)
+            finally:
+                # The upload is not needed once encoded or failed.
+                job.payload = None
+
+    async def _send_loop(self) -> None:
+        while True:
+            job = await self._to_send.get()
+            try:
+                job.start_sending()
+                await self._send(job)
+                job.finish()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Job {job.id} failed while sending: {e}")
+                job.fail(e)
+            finally:
+                job.encoded = None
+            self._finished(job)
+
+    def _finished(self, job: PrintJob) -> None:
+        if self._on_finished is not None:
+            try:
+                self._on_finished(job)
+            except Exception as e:
+                print(f"Job {job.id} finished callback failed: {e}")
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import ExitStack
+from typing import Dict, List, Optional
+
+import cv2
+import httpx
+import numpy as np
+
+from fake_printer import FakePrinter
+
+# Source image sizes (width, height). Every image is scaled to 384 pixels
+# wide, so the height decides how many rows are printed.
+IMAGE_SIZES = {
+    "small": (400, 500),
+    "medium": (400, 1000),
+    "large": (400, 2400),
+}
+
+# Per-job stages reported by /jobs/{job_id}.
+JOB_STAGES = ("queue_wait", "encoding", "send_wait", "sending")
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parses a mix such as "small=3,large=1,text=4" into weights."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name != "text" and name not in IMAGE_SIZES:
+            raise argparse.ArgumentTypeError(f"unknown job kind {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def make_image(width: int, height: int, seed: int) -> bytes:
+    """A PNG with a gradient and noise, so dithering has real work to do."""
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :].repeat(height, axis=0)
+    noise = rng.normal(0, 40, (height, width))
+    ok, png = cv2.imencode(".png", np.clip(gradient + noise, 0, 255).astype(np.uint8))
+    return png.tobytes()
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # The smallest value with at least `fraction` of the values at or below it.
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """Resident memory in bytes of a process and its children (Linux only)."""
+    try:
+        children = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                with open(f"/proc/{entry}/stat") as stat:
+                    ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+        total = 0
+        pending = [pid]
+        while pending:
+            current = pending.pop()
+            pending += children.get(current, [])
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        return total
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LoadTest:
+    """
+    Submits jobs to a running printer server at `rate` jobs per second
+    (Poisson arrivals) for `duration` seconds, then waits for every
+    accepted job to finish. Job kinds are drawn from `mix`. Unless `reuse`
+    is set every upload is distinct, so deduplication and the encode cache
+    do not hide the encoding cost.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        rate: float,
+        duration: float,
+        mix: Dict[str, float],
+        clients: int = 4,
+        reuse: bool = False,
+        seed: int = 0,
+        server_pid: Optional[int] = None,
+        drain_timeout: float = 300.0,
+    ) -> None:
+        self.url = url
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix
+        self.clients = clients
+        self.reuse = reuse
+        self.server_pid = server_pid
+        self.drain_timeout = drain_timeout
+        self._random = random.Random(seed)
+        self._images = {name: make_image(*IMAGE_SIZES[name], seed) for name in mix if name != "text"}
+        self._submitted = 0
+        self.responses: Dict[int, int] = {}
+        self.submit_latencies: List[float] = []
+        self.jobs: List[dict] = []
+        self._job_ids: List[str] = []
+        self.queue_depths: List[float] = []
+        self.rss_samples: List[int] = []
+        self.started_at = 0.0
+        self.finished_at = 0.0
+
+    async def run(self) -> dict:
+        async with httpx.AsyncClient(base_url=self.url, timeout=60.0, limits=httpx.Limits(max_connections=200)) as client:
+            sampler = asyncio.create_task(self._sample(client))
+            self.started_at = time.monotonic()
+            submissions = []
+            deadline = self.started_at + self.duration
+            while True:
+                await asyncio.sleep(self._random.expovariate(self.rate))
+                if time.monotonic() >= deadline:
+                    break
+                submissions.append(asyncio.create_task(self._submit(client)))
+            await asyncio.gather(*submissions)
+            await self._drain(client)
+            self.finished_at = time.monotonic()
+            sampler.cancel()
+            await asyncio.gather(sampler, return_exceptions=True)
+        return self.report()
+
+    async def _submit(self, client: httpx.AsyncClient) -> None:
+        number = self._submitted
+        self._submitted += 1
+        kind = self._random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        headers = {"X-Client-Id": f"loadtest-{number % self.clients}"}
+        started = time.monotonic()
+        try:
+            if kind == "text":
+                text = "Order #1: 2x coffee, 1x bagel" if self.reuse else f"Order #{number}: 2x coffee, 1x bagel"
+                response = await client.post("/print-text/", data={"text": text}, headers=headers)
+            else:
+                image = self._images[kind]
+                if not self.reuse:
+                    # Bytes after the PNG's IEND chunk are ignored by decoders
+                    # but change the content hash.
+                    image += number.to_bytes(8, "little")
+                files = {"file": (f"{kind}.png", image, "image/png")}
+                response = await client.post("/print-image/", files=files, headers=headers)
+        except httpx.HTTPError:
+            self.responses[0] = self.responses.get(0, 0) + 1
+            return
+        self.submit_latencies.append(time.monotonic() - started)
+        self.responses[response.status_code] = self.responses.get(response.status_code, 0) + 1
+        if response.status_code == 202:
+            self._job_ids.append(response.json()["job_id"])
+
+    async def _drain(self, client: httpx.AsyncClient) -> None:
+        pending = list(self._job_ids)
+        deadline = time.monotonic() + self.drain_timeout
+        while pending and time.monotonic() < deadline:
+            still_pending = []
+            for job_id in pending:
+                job = (await client.get(f"/jobs/{job_id}")).json()
+                if job["state"] in ("done", "failed"):
+                    self.jobs.append(job)
+                else:
+                    still_pending.append(job_id)
+            pending = still_pending
+            if pending:
+                await asyncio.sleep(0.5)
+        self.unfinished = len(pending)
+
+    async def _sample(self, client: httpx.AsyncClient) -> None:
+        while True:
+            try:
+                metrics = (await client.get("/metrics")).text
+                for line in metrics.splitlines():
+                    if line.startswith("printer_queue_depth "):
+                        self.queue_depths.append(float(line.split()[1]))
+            except httpx.HTTPError:
+                pass
+            if self.server_pid is not None:
+                rss = process_tree_rss(self.server_pid)
+                if rss is not None:
+                    self.rss_samples.append(rss)
+            await asyncio.sleep(0.5)
+
+    def report(self) -> dict:
+        elapsed = self.finished_at - self.started_at
+        done = [job for job in self.jobs if job["state"] == "done"]
+        rows = sum(job["rows"] or 0 for job in done)
+        latencies = {"submit": self.submit_latencies}
+        for stage in JOB_STAGES:
+            latencies[stage] = [job["timings"][stage] for job in done if stage in job["timings"]]
+        latencies["end_to_end"] = [sum(job["timings"].values()) for job in done]
+        latencies["end_of_job"] = [
+            job["transmission"]["time_to_end_response"] - job["transmission"]["time_to_last_row"]
+            for job in done
+            if job["transmission"] and job["transmission"]["time_to_end_response"] is not None
+        ]
+        return {
+            "target_rate": self.rate,
+            "duration": self.duration,
+            "elapsed": elapsed,
+            "submitted": self._submitted,
+            "responses": {str(code): count for code, count in sorted(self.responses.items())},
+            "done": len(done),
+            "failed": len(self.jobs) - len(done),
+            "unfinished": self.unfinished,
+            "jobs_per_second": len(done) / elapsed if elapsed else None,
+            "rows_per_second": rows / elapsed if elapsed else None,
+            "latency": {
+                stage: {
+                    "p50": percentile(values, 0.50),
+                    "p95": percentile(values, 0.95),
+                    "p99": percentile(values, 0.99),
+                }
+                for stage, values in latencies.items()
+            },
+            "queue_depth_max": max(self.queue_depths, default=None),
+            "queue_depth_mean": sum(self.queue_depths) / len(self.queue_depths) if self.queue_depths else None,
+            "rss_peak_bytes": max(self.rss_samples, default=None),
+        }
+
+
+def format_report(report: dict) -> str:
+    def ms(value):
+        return "n/a" if value is None else f"{value * 1000:.1f}ms"
+
+    def number(value, unit=""):
+        return "n/a" if value is None else f"{value:.1f}{unit}"
+
+    lines = [
+        f"target {report['target_rate']:.2f} jobs/s for {report['duration']:.0f}s, finished after {report['elapsed']:.1f}s",
+        f"submitted {report['submitted']}, responses {report['responses']}",
+        f"done {report['done']}, failed {report['failed']}, unfinished {report['unfinished']}",
+        f"throughput {number(report['jobs_per_second'])} jobs/s, {number(report['rows_per_second'])} rows/s",
+        f"{'stage':<12}{'p50':>12}{'p95':>12}{'p99':>12}",
+    ]
+    for stage, values in report["latency"].items():
+        lines.append(f"{stage:<12}{ms(values['p50']):>12}{ms(values['p95']):>12}{ms(values['p99']):>12}")
+    rss = report["rss_peak_bytes"]
+    lines.append(
+        f"queue depth max {number(report['queue_depth_max'])}, mean {number(report['queue_depth_mean'])}; "
+        f"server RSS peak {'n/a' if rss is None else f'{rss / 2 ** 20:.1f} MiB'}"
+    )
+    return "\n".join(lines)
+
+
+def start_server(ports: List[str], http_port: int, log) -> subprocess.Popen:
+    """Runs printer-server.py under uvicorn against the given printer ports."""
+    env = dict(os.environ, PRINTER_PORTS=",".join(ports))
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "printer-server:app", "--port", str(http_port), "--log-level", "warning"],
+        cwd=SERVER_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def wait_until_ready(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/ready", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"Server at {url} was not ready after {timeout:.0f}s.")
+
+
+def main():
+    """
+    Starts fake printers and the server, runs the load and prints a report.
+    With --url the load is sent to an already running server instead.
+    """
+    parser = argparse.ArgumentParser(description="Load-test printer-server.py against emulated printers.")
+    parser.add_argument("--rate", type=float, default=2.0, help="target submissions per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to keep submitting")
+    parser.add_argument(
+        "--mix", type=parse_mix, default=parse_mix("small=3,medium=2,large=1,text=4"),
+        help="job kinds and weights, from: " + ", ".join(list(IMAGE_SIZES) + ["text"]),
+    )
+    parser.add_argument("--clients", type=int, default=4, help="distinct X-Client-Id values to spread jobs over")
+    parser.add_argument("--reuse", action="store_true", help="send identical payloads, exercising dedup and the cache")
+    parser.add_argument("--seed", type=int, default=0, help="seed for arrivals, job kinds and images")
+    parser.add_argument("--printers", type=int, default=1, help="number of fake printers")
+    parser.add_argument("--rows-per-second", type=float, default=400.0, help="fake print head speed")
+    parser.add_argument("--drain-timeout", type=float, default=300.0, help="seconds to wait for queued jobs")
+    parser.add_argument("--url", help="use a running server instead of starting one")
+    parser.add_argument("--server-log", default=os.devnull, help="file for the server's output")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    with ExitStack() as stack:
+        server_pid = None
+        url = args.url
+        if url is None:
+            printers = [stack.enter_context(FakePrinter(args.rows_per_second)) for _ in range(args.printers)]
+            http_port = free_port()
+            url = f"http://127.0.0.1:{http_port}"
+            log = stack.enter_context(open(args.server_log, "w"))
+            server = start_server([printer.port for printer in printers], http_port, log)
+            stack.callback(server.wait)
+            stack.callback(server.terminate)
+            server_pid = server.pid
+            wait_until_ready(url, timeout=60.0)
+
+        load_test = LoadTest(
+            url, args.rate, args.duration, args.mix, args.clients, args.reuse, args.seed, server_pid, args.drain_timeout
+        )
+        report = asyncio.run(load_test.run())
+
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds, from sub-millisecond stages such as framing a receipt up to
+# minutes spent waiting for a busy printer.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    type = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable] = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Called at scrape time instead of keeping a value, for figures that
+        # are already tracked elsewhere. Returns a number, or for labelled
+        # metrics a dict of label value tuples to numbers.
+        self._function = function
+        self._values: Dict[Labels, float] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        values = self._values
+        if self._function is not None:
+            values = self._function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for key, value in values.items():
+            yield self.name, key, value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """
+    Cumulative histogram in the Prometheus sense. Observing a value is one
+    bisection and two additions, cheap enough for per-job and per-stage use.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def _slots(self, key: Labels) -> List[int]:
+        counts = self._counts.get(key)
+        if counts is None:
+            # One slot per bucket plus the +Inf bucket.
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        return counts
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        self._slots(key)[bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def observe_counts(self, counts: Sequence[int], total: float, **labels) -> None:
+        """
+        Adds values that were already counted into the same buckets
+        elsewhere: `counts` holds one (non-cumulative) count per bucket plus
+        the +Inf bucket, and `total` is the sum of the values.
+        """
+        if len(counts) != len(self.buckets) + 1:
+            raise ValueError(f"Expected {len(self.buckets) + 1} bucket counts, got {len(counts)}.")
+        key = self._key(labels)
+        slots = self._slots(key)
+        for i, count in enumerate(counts):
+            slots[i] += count
+        self._sums[key] += total
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", key, self._sums[key]
+            yield f"{self.name}_count", key, cumulative
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text format."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            labelnames = metric.labelnames
+            bucket_labelnames = labelnames + ("le",)
+            for name, key, value in metric.samples():
+                names = bucket_labelnames if name.endswith("_bucket") else labelnames
+                if names:
+                    labels = ",".join(f'{label}="{_escape(v)}"' for label, v in zip(names, key))
+                    lines.append(f"{name}{{{labels}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,23 @@
+import pytest
+
+from metrics import Histogram, Registry
+
+
+def test_observe_counts_merges_prebucketed_values():
+    registry = Registry()
+    histogram = registry.register(Histogram("write_seconds", "Write latency.", buckets=(0.01, 0.1)))
+    histogram.observe(0.05)
+    histogram.observe_counts([2, 1, 1], 0.5)
+
+    lines = registry.render().splitlines()
+    assert 'write_seconds_bucket{le="0.01"} 2' in lines
+    assert 'write_seconds_bucket{le="0.1"} 4' in lines
+    assert 'write_seconds_bucket{le="+Inf"} 5' in lines
+    assert "write_seconds_count 5" in lines
+    assert "write_seconds_sum 0.55" in lines
+
+
+def test_observe_counts_rejects_other_buckets():
+    histogram = Histogram("write_seconds", "Write latency.", buckets=(0.01, 0.1))
+    with pytest.raises(ValueError):
+        histogram.observe_counts([1, 2], 0.1)
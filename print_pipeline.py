@@ -0,0 +1,160 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Union
+
+import numpy as np
+
+from printer import Printer
+from printer_data import JOB_FOOTER, JOB_HEADER, MAX_ROWS_PER_JOB, append_row_frame, prepare_image
+from process_image_to_packets import iter_image_packets
+
+# Messages from the encoder thread to the writer thread.
+_BEGIN = "begin"
+_ROWS = "rows"
+_SEGMENT_END = "segment_end"
+_END = "end"
+_ABORT = "abort"
+
+_HEADER_BYTES = b''.join(JOB_HEADER)
+_FOOTER_BYTES = b''.join(JOB_FOOTER)
+
+
+class PrintPipeline:
+    """
+    Overlaps encoding with transmission. An encoder thread dithers and frames
+    rows as soon as they are ready and hands them, `chunk_rows` at a time,
+    to a writer thread through a queue of at most `max_chunks` chunks. The
+    writer starts sending a tall job while its later rows are still being
+    dithered, and the encoder moves on to the next job while the previous
+    one is printing. When the queue is full the encoder waits, so memory
+    stays bounded however tall or numerous the jobs are.
+    """
+
+    def __init__(self, printer: Printer, chunk_rows: int = 64, max_chunks: int = 16) -> None:
+        self._printer = printer
+        self._chunk_rows = chunk_rows
+        self._jobs = queue.Queue()
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._threads = [
+            threading.Thread(target=self._encode_loop, daemon=True),
+            threading.Thread(target=self._write_loop, daemon=True),
+        ]
+
+    def start(self) -> 'PrintPipeline':
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def submit(self, frames: Union[np.ndarray, List[np.ndarray]], dithering: bool = True) -> Future:
+        """
+        Queues one job made of a grayscale image, or of several frames printed
+        back to back. The returned future resolves to the seconds from the
+        job's first byte to its end-of-job response, or fails with
+        ValueError for an empty or undecodable frame.
+        """
+        if frames is None or isinstance(frames, np.ndarray):
+            frames = [frames]
+        future = Future()
+        self._jobs.put((frames, dithering, future))
+        return future
+
+    def close(self) -> None:
+        """Finishes every submitted job, then stops both threads."""
+        self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _encode_loop(self) -> None:
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                self._chunks.put(None)
+                return
+            frames, dithering, future = item
+            try:
+                self._encode(frames, dithering, future)
+            except Exception as e:
+                self._chunks.put((_ABORT, future, e, 0))
+
+    def _encode(self, frames: List[np.ndarray], dithering: bool, future: Future) -> None:
+        # Fails before the header is sent for an empty or undecodable frame.
+        frames = [prepare_image(frame) for frame in frames]
+        self._chunks.put((_BEGIN, future, None, 0))
+        buffer = bytearray()
+        pending = 0
+        row = 0
+        for frame in frames:
+            for packet in iter_image_packets(frame, dithering=dithering):
+                # Start a new sub-job before the 16-bit row counter wraps.
+                if row == MAX_ROWS_PER_JOB:
+                    if pending:
+                        self._chunks.put((_ROWS, future, buffer, pending))
+                        buffer, pending = bytearray(), 0
+                    self._chunks.put((_SEGMENT_END, future, None, 0))
+                    self._chunks.put((_BEGIN, future, None, 0))
+                    row = 0
+                append_row_frame(buffer, row, (packet,))
+                row += 1
+                pending += 1
+                if pending == self._chunk_rows:
+                    self._chunks.put((_ROWS, future, buffer, pending))
+                    buffer, pending = bytearray(), 0
+        if pending:
+            self._chunks.put((_ROWS, future, buffer, pending))
+        self._chunks.put((_END, future, None, 0))
+
+    def _write_loop(self) -> None:
+        started = None
+        # Whether the printer has a header without a footer yet.
+        in_job = False
+        # A job that failed mid-way; its remaining chunks are dropped.
+        failed = None
+        while True:
+            item = self._chunks.get()
+            if item is None:
+                return
+            kind, future, payload, rows = item
+            if future is failed:
+                continue
+            try:
+                if kind == _BEGIN:
+                    if started is None:
+                        started = time.monotonic()
+                    self._printer.begin_job()
+                    self._printer.write_frames(_HEADER_BYTES)
+                    in_job = True
+                elif kind == _ROWS:
+                    self._printer.write_frames(payload, rows)
+                elif kind in (_SEGMENT_END, _END):
+                    in_job = False
+                    self._printer.write_frames(_FOOTER_BYTES)
+                    self._printer.wait_for_end()
+                    if kind == _END:
+                        self._printer.jobs_completed += 1
+                        self._printer.last_job_time = time.monotonic() - started
+                        started = None
+                        future.set_result(self._printer.last_job_time)
+                elif kind == _ABORT:
+                    started = None
+                    future.set_exception(payload)
+                    if in_job:
+                        # Close the job the printer already started on and
+                        # consume its end-of-job response, which would
+                        # otherwise end the next job early.
+                        in_job = False
+                        self._printer.write_frames(_FOOTER_BYTES)
+                        self._printer.wait_for_end()
+            except Exception as e:
+                failed = future
+                started = None
+                in_job = False
+                if not future.done():
+                    future.set_exception(e)
@@ -1,7 +1,74 @@
-from printer_data import PrinterData 
+import numpy as np
+
+from printer_data import (
+    JOB_FOOTER, JOB_HEADER, MAX_ROWS_PER_JOB, ROW_FRAME_PREFIX, EncodedJob, PrinterData, encode_image_segments,
+    encode_packets,
+)
+from process_image_to_packets import process_image_to_packets
+
+
+def test_encode_image_segments_splits_at_row_counter():
+    image = np.tile(np.arange(384, dtype=np.uint8), (MAX_ROWS_PER_JOB + 100, 1))
+    jobs = list(encode_image_segments(image, dithering=False))
+    # 32 blank rows of padding follow the image.
+    assert [job.rows for job in jobs] == [MAX_ROWS_PER_JOB, 132]
+    expected = encode_packets(process_image_to_packets(image, dithering=False))
+    assert [bytes(job.buffer) for job in jobs] == [bytes(job.buffer) for job in expected]
+
+
+def test_encode_image_segments_prints_frames_back_to_back():
+    frames = [np.full((400, 384), 0, np.uint8), np.full((500, 384), 255, np.uint8)]
+    (job,) = encode_image_segments(frames, dithering=False)
+    # Each frame keeps its 32 blank rows of padding.
+    assert job.rows == 400 + 32 + 500 + 32
+    assert job.bitplane()[:, 0].tolist() == [0xFF] * 400 + [0] * 564
+    assert row_indices(job) == list(range(job.rows))
+
+
+def row_indices(job: EncodedJob) -> list:
+    offset = len(ROW_FRAME_PREFIX)
+    return [job.buffer[job.row_offset(row) + offset] | (job.buffer[job.row_offset(row) + offset + 1] << 8)
+            for row in range(job.rows)]
+
+
+def packets(count: int, first: int) -> list:
+    return [bytes([(first + i) % 256]) * 48 for i in range(count)]
+
+
+def test_concat_renumbers_rows_across_items():
+    a = next(encode_packets(packets(3, 0)))
+    b = next(encode_packets(packets(5, 3)))
+
+    (job,) = EncodedJob.concat([a, b])
+
+    assert job.rows == 8
+    assert row_indices(job) == list(range(8))
+    assert job.bitplane()[:, 0].tolist() == list(range(8))
+    assert bytes(job.header()) == b''.join(JOB_HEADER)
+    assert bytes(job.footer()) == b''.join(JOB_FOOTER)
+    assert bytes(job.buffer) == bytes(next(encode_packets(packets(8, 0))).buffer)
+    # The items themselves are left as they were.
+    assert row_indices(b) == list(range(5))
+
+
+def test_concat_splits_at_row_counter():
+    a = next(encode_packets(packets(MAX_ROWS_PER_JOB - 2, 0)))
+    b = next(encode_packets(packets(5, MAX_ROWS_PER_JOB - 2)))
+
+    first, second = EncodedJob.concat([a, b])
+
+    assert (first.rows, second.rows) == (MAX_ROWS_PER_JOB, 3)
+    assert row_indices(first)[-2:] == [MAX_ROWS_PER_JOB - 2, MAX_ROWS_PER_JOB - 1]
+    assert row_indices(second) == [0, 1, 2]
+    assert second.bitplane()[:, 0].tolist() == [(MAX_ROWS_PER_JOB + i) % 256 for i in range(3)]
+
+
+def test_concat_of_nothing():
+    assert EncodedJob.concat([]) == []
+
 
 def main():
     data_1 = PrinterData.from_string("this is a test string", debug_output=True)
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
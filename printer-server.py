@@ -1,69 +1,430 @@
-import io
-import cv2
-import numpy as np
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from printer import Printer
-from printer_data import PrinterData
-from process_image_to_packets import process_image_to_packets
+import asyncio
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from fastapi import FastAPI, File, Form, Header, Request, UploadFile, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from flow_control import DEFAULT_ROWS_PER_SECOND
+from printer_pool import PrinterPool
+from transmission_stats import WRITE_LATENCY_BUCKETS, TransmissionStats
+from ingest import (
+    decode_upload, encode_image, encode_text, prepared_rows, render_preview, timed, upload_key, warmup,
+    warmup_worker, worker_warmup_error,
+)
+from jobs import JobQueue, JobState, PrintJob
+from scheduler import Priority
+from admission import AdmissionController, UploadLimitMiddleware
+from encode_cache import EncodedJobCache, cache_key
+from dedup import RecentSubmissions
+from metrics import Counter, Gauge, Histogram, Registry
+from printer_connection import ConnectionState
+from printer_data import EncodedJob
 
 # --- 配置 ---
 # !!! 重要 !!!
 # 在运行前，请将此处的串口地址修改为您的打印机所连接的实际地址。
 # 在 Linux 上通常是 /dev/rfcomm0
-SERIAL_PORT = "/dev/rfcomm0"
+# 有多台打印机时，把每台的串口地址都列在这里，任务会分配给最空闲的打印机。
+# 也可以用环境变量 PRINTER_PORTS 指定（逗号分隔），例如压测时指向模拟打印机。
+SERIAL_PORTS = os.environ.get("PRINTER_PORTS", "/dev/rfcomm0").split(",")
 
-# --- FastAPI 应用实例 ---
-app = FastAPI(
-    title="Guagua Printer Driver Server",
-    description="A server to receive images and print them on a Guagua thermal printer.",
-    version="1.0.0",
+# 同时在途（已发送但打印头尚未打印）的最大行数，会根据打印机的实际速度自动调整。
+FLOW_WINDOW_ROWS = 128
+# 打印速度（行/秒）的初始估计，之后根据每个任务从开始到打印机确认结束的时间自动调整。
+# 知道打印机的实际速度时可以用环境变量 PRINTER_ROWS_PER_SECOND 指定，省去开头的试探。
+FLOW_ROWS_PER_SECOND = float(os.environ.get("PRINTER_ROWS_PER_SECOND", DEFAULT_ROWS_PER_SECOND))
+
+# 每台打印机的连接在整个服务器生命周期内保持打开，链路断开时自动带退避重连；
+# 连续失败的打印机会被暂时移出轮换。
+printer_pool = PrinterPool(SERIAL_PORTS, flow_window=FLOW_WINDOW_ROWS, rows_per_second=FLOW_ROWS_PER_SECOND)
+
+# 用于图片解码和抖动的工作进程数，默认与CPU核心数相同。
+ENCODE_WORKERS = os.cpu_count() or 1
+encode_executor: Optional[ProcessPoolExecutor] = None
+
+# 准入控制：超过以下任一限制时返回 429 并附带 Retry-After，避免队列和内存无限增长。
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024       # 单个上传的最大字节数，超过返回 413
+MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024   # 等待抖动编码的图像总字节数
+MAX_QUEUE_DEPTH = 100                     # 尚未完成的任务数
+MAX_QUEUED_ROWS = 200_000                 # 尚未打印的总行数（估计值）
+
+admission = AdmissionController(
+    MAX_BYTES_IN_FLIGHT,
+    MAX_QUEUE_DEPTH,
+    MAX_QUEUED_ROWS,
+    # 所有打印机的估计打印速度之和，用于计算 Retry-After
+    rows_per_second=lambda: sum(member.flow.rows_per_second for member in printer_pool.members),
 )
 
-# --- 辅助函数 ---
-def create_printer_data_from_image(image: np.ndarray, dithering: bool = True) -> PrinterData:
+# 同时进行的预览数。预览不进打印队列，但解码和抖动与打印任务共用编码进程池，
+# 超过时直接返回 429，以免预览请求挤占打印任务的编码。
+MAX_CONCURRENT_PREVIEWS = max(1, ENCODE_WORKERS // 2)
+preview_slots = asyncio.Semaphore(MAX_CONCURRENT_PREVIEWS)
+
+# 文本打印的最大字符数
+MAX_TEXT_LENGTH = 4000
+
+# 一次批量打印最多的图片数（所有图片一起受 MAX_UPLOAD_BYTES 限制）
+MAX_BATCH_ITEMS = 50
+
+# 编码结果缓存：相同的内容和选项直接复用已编码的行，不再重复渲染和抖动。
+encode_cache = EncodedJobCache(max_bytes=64 * 1024 * 1024)
+
+# 幂等与去重：重复提交时直接返回已有的任务，不再编码和打印。
+# 客户端可以发送 Idempotency-Key 请求头，窗口内重复的键返回同一个任务；
+# 没有发送的客户端在超时重试时，同一客户端短时间内提交相同内容和选项也视为重复
+# （窗口较短，以免误伤有意重复打印的相同小票，设为0即关闭）。
+IDEMPOTENCY_WINDOW = 3600  # 秒
+CONTENT_DEDUP_WINDOW = 30  # 秒
+recent_keys = RecentSubmissions(window=IDEMPOTENCY_WINDOW)
+recent_contents = RecentSubmissions(window=CONTENT_DEDUP_WINDOW)
+
+
+def submission_keys(client: str, idempotency_key: Optional[str], content_key: Optional[str] = None) -> list:
+    keys = []
+    if idempotency_key:
+        keys.append((recent_keys, f"{client}\0{idempotency_key}"))
+    if content_key:
+        keys.append((recent_contents, f"{client}\0{content_key}"))
+    return keys
+
+
+def find_duplicate(keys: list) -> Optional[PrintJob]:
+    for recent, key in keys:
+        job_id = recent.get(key)
+        job = job_queue.get(job_id) if job_id else None
+        # 失败的任务允许重新提交
+        if job is not None and job.state != JobState.FAILED:
+            return job
+    return None
+
+
+# 正在处理的带 Idempotency-Key 的提交（键与 recent_keys 相同），到它进入队列或失败为止。
+pending_keys: Dict[str, asyncio.Future] = {}
+
+
+@asynccontextmanager
+async def reserve_idempotency_key(client: str, idempotency_key: Optional[str]):
     """
-    从一个Numpy图像数组创建PrinterData对象，包含了旋转、缩放和数据包转换的逻辑。
+    在请求的第一次 await 之前占用 Idempotency-Key，直到退出为止，得到已有的任务或 None。
+    第一个请求还在计算哈希或解码时到达的重试会等它结束：它提交成功时返回它的任务，
+    失败或被拒绝时重试照常提交。
     """
-    if image is None:
-        raise ValueError("Invalid image data provided.")
+    future = None
+    if idempotency_key:
+        key = f"{client}\0{idempotency_key}"
+        while True:
+            duplicate = find_duplicate([(recent_keys, key)])
+            if duplicate is not None:
+                yield duplicate
+                return
+            pending = pending_keys.get(key)
+            if pending is None:
+                break
+            await asyncio.shield(pending)
+        future = pending_keys[key] = asyncio.get_running_loop().create_future()
+    try:
+        yield None
+    finally:
+        if future is not None:
+            del pending_keys[key]
+            future.set_result(None)
+
+
+def submit(job: PrintJob, nbytes: int, keys: list) -> dict:
+    admission.admit(job.id, nbytes, job.cost)
+    # 任务进入队列后立即返回，请求延迟不再取决于打印时间。
+    job_queue.submit(job)
+    for recent, key in keys:
+        recent.add(key, job.id)
+    print(f"Job {job.id} queued.")
+    return job_response(job)
+
+
+def job_response(job: PrintJob, duplicate: bool = False) -> dict:
+    return {
+        "job_id": job.id,
+        "state": job.state.value,
+        "status_url": f"/jobs/{job.id}",
+        "duplicate": duplicate,
+    }
+
+
+# --- 指标 ---
+# 进程内的轻量计数器和直方图，由 /metrics 以 Prometheus 文本格式导出。
+# 已在别处统计的数字（队列深度、缓存命中等）在抓取时才读取，不增加热路径开销。
+metrics = Registry()
+STAGE_SECONDS = metrics.register(Histogram(
+    "printer_stage_seconds",
+    "Seconds spent per job in each stage: decode, resize, render, dither, framing, "
+    "queue_wait, send_wait, transmission and end_of_job.",
+    ["stage"],
+))
+JOBS_FINISHED = metrics.register(Counter(
+    "printer_jobs_finished_total", "Print jobs that finished, by kind and final state.", ["kind", "state"]
+))
+ROWS_PRINTED = metrics.register(Counter("printer_rows_printed_total", "Rows sent to printers by finished jobs."))
+BYTES_SENT = metrics.register(Counter("printer_bytes_sent_total", "Bytes written to printers by finished jobs."))
+WRITE_SECONDS = metrics.register(Histogram(
+    "printer_write_seconds",
+    "Seconds each write to a printer took, waits for the link included.",
+    buckets=WRITE_LATENCY_BUCKETS,
+))
+metrics.register(Gauge("printer_queue_depth", "Jobs submitted but not yet sending.", function=lambda: job_queue.depth))
+metrics.register(Gauge(
+    "printer_queued_rows", "Rows admitted but not yet printed.", function=lambda: admission.queued_rows
+))
+metrics.register(Gauge(
+    "printer_bytes_in_flight", "Image bytes waiting to be encoded.", function=lambda: admission.bytes_in_flight
+))
+metrics.register(Counter(
+    "printer_admission_rejected_total", "Submissions refused with 429.", function=lambda: admission.rejected
+))
+metrics.register(Counter(
+    "printer_encode_cache_requests_total",
+    "Encode cache lookups, by result.",
+    ["result"],
+    function=lambda: {("hit",): encode_cache.hits, ("miss",): encode_cache.misses},
+))
+metrics.register(Gauge("printer_encode_cache_bytes", "Bytes held by the encode cache.", function=lambda: encode_cache.size))
+metrics.register(Gauge(
+    "printer_connection_state",
+    "1 for the current connection state of each printer port, 0 for the others.",
+    ["port", "state"],
+    function=lambda: {
+        (member.port, state.value): int(member.connection.state == state)
+        for member in printer_pool.members
+        for state in ConnectionState
+    },
+))
+metrics.register(Counter(
+    "printer_reconnects_total",
+    "Reconnections per printer port.",
+    ["port"],
+    function=lambda: {(member.port,): member.connection.reconnects for member in printer_pool.members},
+))
+metrics.register(Gauge(
+    "printer_rows_per_second",
+    "Estimated print head speed per printer port.",
+    ["port"],
+    function=lambda: {(member.port,): member.flow.rows_per_second for member in printer_pool.members},
+))
+
+
+def observe_stages(timings: dict) -> None:
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def on_job_finished(job: PrintJob) -> None:
+    # 批量任务中已编码的图片随整个任务一起完成或失败
+    for item in job.items or ():
+        if item["state"] == "encoded":
+            item["state"] = job.state.value
+    JOBS_FINISHED.inc(kind=job.options.get("kind", "image"), state=job.state.value)
+    for stage, name in (("queue_wait", "queue_wait"), ("send_wait", "send_wait"), ("sending", "transmission")):
+        if stage in job.timings:
+            STAGE_SECONDS.observe(job.timings[stage], stage=name)
+    if job.transmission:
+        ROWS_PRINTED.inc(job.transmission["rows_sent"])
+        BYTES_SENT.inc(job.transmission["bytes_sent"])
+        WRITE_SECONDS.observe_counts(
+            list(job.transmission["write_latency_buckets"].values()),
+            job.transmission["write_latency_sum"],
+        )
+        last_row = job.transmission["time_to_last_row"]
+        end_response = job.transmission["time_to_end_response"]
+        if last_row is not None and end_response is not None:
+            # 最后一行发出到打印机确认任务结束之间的时间
+            STAGE_SECONDS.observe(end_response - last_row, stage="end_of_job")
+
+
+# 按任务类型选择编码函数，它们都在编码进程池中执行。
+ENCODERS = {
+    "image": encode_image,
+    "text": encode_text,
+}
+
+
+async def encode_payload(kind: str, payload, dithering: bool, key: Optional[str] = None) -> list:
+    # 抖动和编码是CPU密集的工作，放到进程池中执行，
+    # 这样事件循环不会被阻塞，并发请求可以利用多个CPU核心。
+    # 传给工作进程的只是已缩放到384像素宽的图像，而不是原始上传。
+    loop = asyncio.get_running_loop()
+    encoded, timings = await loop.run_in_executor(encode_executor, timed, ENCODERS[kind], payload, dithering)
+    observe_stages(timings)
+    if key:
+        encode_cache.put(key, encoded)
+    return encoded
+
+
+async def encode_batch(job: PrintJob) -> List[EncodedJob]:
+    # 各图片同时提交给进程池并行编码，解码失败或编码失败的图片单独标记，其余照常打印。
+    dithering = job.options.get("dithering", True)
+
+    async def encode_item(item: dict, entry: dict) -> None:
+        try:
+            if entry["encoded"] is None:
+                entry["encoded"] = await encode_payload("image", entry["image"], dithering, entry["key"])
+                entry["image"] = None
+        except Exception as e:
+            item["state"] = "failed"
+            item["error"] = str(e) or type(e).__name__
+            return
+        item["state"] = "encoded"
+        item["rows"] = sum(encoded.rows for encoded in entry["encoded"])
+
+    pending = [(item, entry) for item, entry in zip(job.items, job.payload) if item["state"] != "failed"]
+    await asyncio.gather(*(encode_item(item, entry) for item, entry in pending))
+    encoded = [part for item, entry in pending if item["state"] == "encoded" for part in entry["encoded"]]
+    if not encoded:
+        raise ValueError("None of the images in the batch could be encoded.")
+    if job.options["mode"] == "continuous":
+        # 所有图片的行连成一个任务，只有一次任务头和任务尾
+        return EncodedJob.concat(encoded)
+    # 按顺序逐个打印，每张图片是一个独立的打印任务，但都在同一台打印机上
+    return encoded
+
+
+async def encode_job(job: PrintJob) -> None:
+    try:
+        if job.options.get("kind") == "batch":
+            job.encoded = await encode_batch(job)
+        # 命中缓存的任务在提交时就已经有编码结果
+        elif job.encoded is None:
+            job.encoded = await encode_payload(
+                job.options.get("kind", "image"),
+                job.payload,
+                job.options.get("dithering", True),
+                job.options.get("cache_key"),
+            )
+    except BaseException:
+        admission.release(job.id)
+        raise
+    finally:
+        # 图像编码后不再需要，归还内存预算
+        admission.release_bytes(job.id)
+    job.rows = sum(encoded.rows for encoded in job.encoded)
+    admission.update_rows(job.id, job.rows)
+
+
+async def send_job(job: PrintJob) -> None:
+    # 发送给最空闲的打印机
+    stats = TransmissionStats()
+    # 进度事件直接读取传输层的行计数
+    job.stats = stats
+    try:
+        member = await printer_pool.send(job.encoded, stats)
+    finally:
+        admission.release(job.id)
+    job.port = member.port
+    job.transmission = stats.summary()
+    print(f"Job {job.id} printed on {member.port}: {stats.format()}")
 
-    height, width = image.shape
 
-    # 如果图像是横向的（宽大于高），则旋转90度
-    if width > height:
-        print("Image is wider than tall, rotating 90 degrees.")
-        image = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        height, width = image.shape
+# 每台打印机一个发送工作者，编码工作者与编码进程数相同。
+job_queue = JobQueue(
+    encode_job,
+    send_job,
+    encode_workers=ENCODE_WORKERS,
+    send_workers=len(SERIAL_PORTS),
+    on_finished=on_job_finished,
+)
+
+
+# 启动预热的状态，预热完成前 /ready 返回 503
+warmup_status = {"ready": False, "seconds": None, "steps": {}, "error": None}
+warmup_task: Optional[asyncio.Task] = None
+
 
-    # 打印机的打印宽度是384像素（48字节）。如果图像宽度不是384，则进行缩放。
-    if width != 384:
-        print(f"Image width is {width}, resizing to 384.")
-        aspect_ratio = height / width
-        new_height = int(384 * aspect_ratio)
-        image = cv2.resize(image, (384, new_height))
+async def warm_up() -> None:
+    started = time.monotonic()
+    steps = warmup_status["steps"]
+    step = "printers"
+    try:
+        # 预先打开串口，这样第一个任务不必承担 RFCOMM 的建立延迟。
+        await asyncio.to_thread(printer_pool.connect)
+        steps["printers"] = time.monotonic() - started
+        # 主进程负责解码上传和渲染预览，在这里预热。
+        step = "main_process"
+        steps["main_process"] = await asyncio.to_thread(warmup)
+        # 编码进程不继承主进程的预热，而是各自在启动时运行 warmup_worker（进程池的 initializer）。
+        # 这里提交与进程数相同的任务，让编码进程现在就启动、完成预热并报告预热是否失败。
+        step = "encode_workers"
+        loop = asyncio.get_running_loop()
+        worker_started = time.monotonic()
+        errors = await asyncio.gather(
+            *(loop.run_in_executor(encode_executor, worker_warmup_error) for _ in range(ENCODE_WORKERS))
+        )
+        errors = sorted({error for error in errors if error})
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        steps["encode_workers"] = time.monotonic() - worker_started
+    except Exception as e:
+        # 预热失败时仍然处理任务（第一个任务承担初始化开销），但不报告就绪，
+        # /ready 返回 503 并给出失败的步骤和原因。
+        warmup_status["error"] = f"{step}: {type(e).__name__}: {e}"
+        print(f"Warmup failed in step {warmup_status['error']}")
+        traceback.print_exc()
+        return
+    finally:
+        # 预热结束后才开始处理队列，在此之前提交的任务会排队等待。
+        job_queue.start()
+    warmup_status["seconds"] = time.monotonic() - started
+    warmup_status["ready"] = True
+    print(f"Warmup finished in {warmup_status['seconds'] * 1000:.0f}ms, ready.")
 
-    # 将处理后的图像转换为打印数据包
-    packets = process_image_to_packets(image, dithering=dithering)
 
-    # 创建一个PrinterData实例，其高度与数据包数量相匹配
-    printer_data = PrinterData(height=len(packets))
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global encode_executor, warmup_task
+    encode_executor = ProcessPoolExecutor(max_workers=ENCODE_WORKERS, initializer=warmup_worker)
+    # 预热在后台进行，服务器立即开始接受请求（存活），预热完成后才报告就绪。
+    warmup_task = asyncio.create_task(warm_up())
+    yield
+    warmup_task.cancel()
+    await asyncio.gather(warmup_task, return_exceptions=True)
+    await job_queue.stop()
+    printer_pool.close()
+    encode_executor.shutdown()
 
-    # 构建打印机可接受的data_array格式
-    new_data_array = []
-    for packet in packets:
-        # 每个数据包是长度为48的bytes对象。
-        # data_array需要的是一个由单字节列表组成的列表。
-        row = [[byte] for byte in packet]
-        new_data_array.append(row)
 
-    printer_data.data_array = new_data_array
-    return printer_data
+# --- FastAPI 应用实例 ---
+app = FastAPI(
+    title="Guagua Printer Driver Server",
+    description="A server to receive images and print them on a Guagua thermal printer.",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+# 过大的上传在读完之前就被拒绝（413），不会先整个缓存到内存或磁盘。
+app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
 
 # --- API 端点 ---
-@app.post("/print-image/", summary="Upload and Print Image")
-async def print_image(file: UploadFile = File(...)):
+def check_image_type(file: UploadFile) -> None:
+    # 检查上传的文件类型
+    if file.content_type not in ["image/jpeg", "image/png", "image/bmp"]:
+        raise HTTPException(
+            status_code=415,
+            detail="Unsupported file type. Please upload a JPG, PNG, or BMP image."
+        )
+
+
+@app.post("/print-image/", summary="Upload and Print Image", status_code=202)
+async def print_image(
+    request: Request,
+    file: UploadFile = File(...),
+    priority: str = Form("normal"),
+    x_client_id: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+):
     """
-    接收用户上传的图片文件，将其转换为打印数据，并通过串口发送给打印机。
+    接收用户上传的图片文件并放入打印队列，立即返回任务ID（202 Accepted）。
+    后台工作者会将其转换为打印数据并通过串口发送给打印机，
+    可通过 `/jobs/{job_id}` 查询进度。
 
     - **支持的图片格式**: `image/jpeg`, `image/png`, `image/bmp`
     - **图片处理**:
@@ -71,44 +432,342 @@ async def print_image(file: UploadFile = File(...)):
         - 如果图片宽度大于高度，会自动旋转90度。
         - 图片宽度会被自动缩放到384像素以适应打印机。
         - 默认启用Floyd-Steinberg抖动算法以提升打印质量。
+        - 无法解码的图片立即返回 400。
+    - **调度**:
+        - `priority` 可以是 `interactive`、`normal` 或 `bulk`，高优先级的任务先打印。
+        - 同一优先级内较短的任务优先，并在客户端之间（按 `X-Client-Id` 请求头或客户端地址区分）公平分配打印机。
+    - **背压**:
+        - 上传超过大小限制时返回 413。
+        - 队列已满时返回 429，`Retry-After` 响应头给出建议的重试秒数。
+    - **幂等**:
+        - 带相同 `Idempotency-Key` 请求头的重试，或同一客户端在短时间内重复提交相同的图片，
+          会返回已有的任务（`duplicate` 为 true），不会重复打印。
+        - 相同图片的编码结果会被缓存，再次打印时跳过解码和抖动。
     """
-    # 检查上传的文件类型
-    if file.content_type not in ["image/jpeg", "image/png", "image/bmp"]:
-        raise HTTPException(
-            status_code=415,
-            detail="Unsupported file type. Please upload a JPG, PNG, or BMP image."
+    check_image_type(file)
+    try:
+        job_priority = Priority[priority.upper()]
+    except KeyError:
+        raise HTTPException(status_code=422, detail="priority must be one of: interactive, normal, bulk.")
+    client = x_client_id or (request.client.host if request.client else "")
+
+    # 带相同 Idempotency-Key 的重试不必再看上传内容
+    async with reserve_idempotency_key(client, idempotency_key) as duplicate:
+        if duplicate is not None:
+            await file.close()
+            return job_response(duplicate, duplicate=True)
+        try:
+            # 上传内容此时已由 FastAPI 接收并暂存（大小由 UploadLimitMiddleware 限制），
+            # 在计算哈希和解码之前先做廉价的队列深度检查
+            admission.check_depth()
+
+            # 在线程中直接从 Starlette 的临时文件计算内容哈希和解码（不把上传读成 bytes），
+            # 处理完立即关闭临时文件，队列中只保留缩放后的图像。
+            key = await asyncio.to_thread(upload_key, file.file, dithering=True)
+            keys = submission_keys(client, idempotency_key, key)
+            duplicate = find_duplicate(keys)
+            if duplicate is not None:
+                return job_response(duplicate, duplicate=True)
+
+            job = PrintJob(
+                None, priority=job_priority, client=client, kind="image", dithering=True, cache_key=key
+            )
+            # 相同的图片已经编码过时，直接复用缓存的编码结果，连解码也可以跳过
+            job.encoded = encode_cache.get(key)
+            if job.encoded is not None:
+                job.rows = sum(encoded.rows for encoded in job.encoded)
+                return submit(job, 0, keys)
+            job.payload, timings = await asyncio.to_thread(timed, decode_upload, file.file)
+            observe_stages(timings)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
+        finally:
+            await file.close()
+
+        job.estimated_rows = prepared_rows(job.payload)
+        return submit(job, job.payload.nbytes, keys)
+
+
+@app.post("/print-batch/", summary="Upload and Print Several Images", status_code=202)
+async def print_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    mode: str = Form("continuous"),
+    priority: str = Form("normal"),
+    x_client_id: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    一次上传多张图片（例如一组标签）作为一个打印任务，立即返回任务ID（202 Accepted）。
+    各图片在进程池中并行解码和抖动，整批任务只占用一次请求和一次排队。
+
+    - **mode**:
+        - `continuous`（默认）：所有图片按上传顺序连成一个连续的打印任务，只有一次任务头和任务尾。
+        - `series`：按上传顺序逐张打印，每张图片是独立的打印任务，全部在同一台打印机上。
+    - **逐项状态**: `/jobs/{job_id}` 的 `items` 给出每张图片的状态（queued、encoded、done、failed）、
+      行数和错误；无法解码的图片被跳过，其余图片照常打印。
+    - 最多 `MAX_BATCH_ITEMS` 张图片；图片格式、**调度**、**背压** 和 **幂等** 与 `/print-image/` 相同。
+    """
+    for file in files:
+        check_image_type(file)
+    if len(files) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=422, detail=f"A batch can hold at most {MAX_BATCH_ITEMS} images.")
+    if mode not in ("continuous", "series"):
+        raise HTTPException(status_code=422, detail="mode must be one of: continuous, series.")
+    try:
+        job_priority = Priority[priority.upper()]
+    except KeyError:
+        raise HTTPException(status_code=422, detail="priority must be one of: interactive, normal, bulk.")
+    client = x_client_id or (request.client.host if request.client else "")
+
+    async def prepare_item(file: UploadFile) -> dict:
+        # 与 /print-image/ 相同：从临时文件计算内容哈希，命中缓存时跳过解码
+        key = await asyncio.to_thread(upload_key, file.file, dithering=True)
+        entry = {"key": key, "image": None, "encoded": encode_cache.get(key)}
+        if entry["encoded"] is None:
+            entry["image"], timings = await asyncio.to_thread(timed, decode_upload, file.file)
+            observe_stages(timings)
+        return entry
+
+    async with reserve_idempotency_key(client, idempotency_key) as duplicate:
+        if duplicate is not None:
+            for file in files:
+                await file.close()
+            return job_response(duplicate, duplicate=True)
+        try:
+            admission.check_depth()
+            # 各图片在线程中并行解码（OpenCV 解码时释放GIL）
+            entries = await asyncio.gather(*map(prepare_item, files), return_exceptions=True)
+        finally:
+            for file in files:
+                await file.close()
+
+        items = []
+        payload = []
+        for index, (file, entry) in enumerate(zip(files, entries)):
+            item = {"index": index, "filename": file.filename, "state": "queued", "rows": None, "error": None}
+            if isinstance(entry, Exception):
+                item.update(state="failed", error=str(entry) or type(entry).__name__)
+                entry = {"key": None, "image": None, "encoded": None}
+            elif entry["encoded"] is not None:
+                item["rows"] = sum(encoded.rows for encoded in entry["encoded"])
+            items.append(item)
+            payload.append(entry)
+        if all(item["state"] == "failed" for item in items):
+            raise HTTPException(status_code=400, detail="None of the images in the batch could be decoded.")
+
+        content_key = cache_key("batch", "".join(entry["key"] or "" for entry in payload).encode(), mode=mode)
+        keys = submission_keys(client, idempotency_key, content_key)
+        duplicate = find_duplicate(keys)
+        if duplicate is not None:
+            return job_response(duplicate, duplicate=True)
+
+        job = PrintJob(payload, priority=job_priority, client=client, kind="batch", mode=mode, dithering=True)
+        job.items = items
+        job.estimated_rows = sum(
+            item["rows"] if item["rows"] is not None else prepared_rows(entry["image"])
+            for item, entry in zip(items, payload)
+            if item["state"] != "failed"
         )
+        nbytes = sum(entry["image"].nbytes for entry in payload if entry["image"] is not None)
+        response = submit(job, nbytes, keys)
+        response["items"] = items
+        return response
+
+
+@app.post(
+    "/preview/",
+    summary="Preview Image Print",
+    response_class=Response,
+    responses={200: {"content": {"image/png": {}}}},
+)
+async def preview(file: UploadFile = File(...)):
+    """
+    返回上传的图片打印出来的样子（1位PNG，384像素宽），不消耗纸张。
 
+    - 与 `/print-image/` 使用完全相同的解码、缩放和抖动流程，
+      预览图直接由将要发送给打印机的数据行还原。
+    - 编码结果会存入缓存，之后用 `/print-image/` 打印同一张图片时跳过解码和抖动，
+      直接发送。
+    - **背压**：打印队列已满，或同时进行的预览超过 `MAX_CONCURRENT_PREVIEWS` 个时
+      返回 429 并附带 `Retry-After`。
+    """
+    check_image_type(file)
     try:
-        # 读取上传文件的二进制内容
-        image_bytes = await file.read()
+        admission.check_depth()
+        if preview_slots.locked():
+            raise HTTPException(
+                status_code=429,
+                detail="Too many previews in progress. Please retry later.",
+                headers={"Retry-After": "1"},
+            )
+        async with preview_slots:
+            key = await asyncio.to_thread(upload_key, file.file, dithering=True)
+            encoded = encode_cache.get(key)
+            if encoded is None:
+                image, timings = await asyncio.to_thread(timed, decode_upload, file.file)
+                observe_stages(timings)
+                encoded = await encode_payload("image", image, True, key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await file.close()
 
-        # 将二进制数据转换为Numpy数组，然后解码为OpenCV图像
-        np_array = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(np_array, cv2.IMREAD_GRAYSCALE)
+    png = await asyncio.to_thread(render_preview, encoded)
+    return Response(png, media_type="image/png")
 
-        if image is None:
-            raise HTTPException(status_code=400, detail="Could not decode the image. The file may be corrupt or in an unsupported format.")
 
-        # 从图像创建PrinterData对象
-        print("Processing image for printing...")
-        printer_data = create_printer_data_from_image(image, dithering=True)
+@app.post("/print-text/", summary="Print Text", status_code=202)
+async def print_text(
+    request: Request,
+    text: str = Form(..., min_length=1, max_length=MAX_TEXT_LENGTH),
+    priority: str = Form("normal"),
+    x_client_id: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    接收一段文字并放入打印队列，立即返回任务ID（202 Accepted）。
+    文字按打印宽度（384像素）横向排版、自动换行，不旋转也不缩放，
+    黑白渲染不做抖动，一行文字只占几十行点阵。
 
-        # 初始化打印机并发送数据
-        print(f"Sending image to printer on port: {SERIAL_PORT}")
-        printer = Printer(SERIAL_PORT)
-        printer.run(printer_data)
-        print("Image sent successfully!")
+    - **性能**:
+        - 字体在每个编码进程中只加载一次，文字在内存中渲染，不写临时文件。
+        - 相同文字的编码结果会被缓存，重复打印（例如相同的小票模板）直接复用，不再编码。
+    - **调度**、**背压** 和 **幂等** 与 `/print-image/` 相同。
+    """
+    try:
+        job_priority = Priority[priority.upper()]
+    except KeyError:
+        raise HTTPException(status_code=422, detail="priority must be one of: interactive, normal, bulk.")
+    client = x_client_id or (request.client.host if request.client else "")
 
-        return {"status": "success", "message": "Image sent to printer."}
+    key = cache_key("text", text.encode(), dithering=False)
+    keys = submission_keys(client, idempotency_key, key)
+    duplicate = find_duplicate(keys)
+    if duplicate is not None:
+        return job_response(duplicate, duplicate=True)
+    admission.check_depth()
 
-    except HTTPException as e:
-        # 重新抛出HTTP异常
-        raise e
-    except Exception as e:
-        # 捕获其他所有异常
-        print(f"An error occurred: {e}")
-        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
+    job = PrintJob(text, priority=job_priority, client=client, kind="text", dithering=False, cache_key=key)
+    job.encoded = encode_cache.get(key)
+    if job.encoded is not None:
+        job.rows = sum(encoded.rows for encoded in job.encoded)
+    return submit(job, len(text.encode()), keys)
+
+
+@app.get("/jobs/{job_id}", summary="Print Job Status")
+async def job_status(job_id: str):
+    """
+    返回打印任务的状态（queued、encoding、sending、done、failed）、
+    各阶段耗时以及发送统计。
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+    return job.to_dict()
+
+# 进度事件的推送间隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+
+def job_progress(job: PrintJob, rows_per_second: Optional[float]) -> dict:
+    stats = job.stats
+    total = job.cost
+    rows_sent = stats.rows_sent if stats else 0
+    eta = None
+    if rows_per_second:
+        eta = max(0, total - rows_sent) / rows_per_second
+    return {
+        "job_id": job.id,
+        "state": job.state.value,
+        "rows_sent": rows_sent,
+        "rows_total": total,
+        "rows_per_second": rows_per_second,
+        "eta_seconds": eta,
+        # 打印机确认了结束的（子）任务数
+        "end_confirmations": stats.end_responses if stats else 0,
+    }
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/jobs/{job_id}/events", summary="Print Job Progress Events")
+async def job_events(job_id: str, request: Request):
+    """
+    以 Server-Sent Events 推送打印进度，客户端无需轮询。
+
+    - `progress` 事件：已发送行数/总行数、最近的发送速度（行/秒）和预计剩余时间，
+      进度变化时每 `PROGRESS_INTERVAL` 秒最多推送一次。
+    - 最后一个事件是 `done`（打印机已确认任务结束）或 `failed`（附带错误），之后连接关闭。
+
+    进度直接读取传输层已有的行计数，不在发送路径上增加任何回调。
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+
+    async def events():
+        last = None
+        last_rows, last_time = 0, time.monotonic()
+        rate = None
+        while not job.finished.is_set():
+            now = time.monotonic()
+            rows_sent = job.stats.rows_sent if job.stats else 0
+            if rows_sent > last_rows:
+                # 最近一个间隔内的速度，平滑后用于估计剩余时间
+                recent = (rows_sent - last_rows) / (now - last_time)
+                rate = recent if rate is None else rate + 0.5 * (recent - rate)
+            last_rows, last_time = rows_sent, now
+            progress = job_progress(job, rate)
+            if progress != last:
+                yield sse_event("progress", progress)
+                last = progress
+            if await request.is_disconnected():
+                return
+            try:
+                await asyncio.wait_for(job.finished.wait(), PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        final = job_progress(job, rate)
+        final["error"] = job.error
+        final["transmission"] = job.transmission
+        yield sse_event(job.state.value, final)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/ready", summary="Readiness")
+async def ready():
+    """
+    就绪检查：启动预热（打开串口、加载字体和编解码器、预热每个编码进程）完成后返回 200，
+    之前返回 503。响应中包含各预热步骤的耗时；预热失败时一直返回 503，
+    `error` 中给出失败的步骤和原因，任务仍会照常处理。
+    """
+    return JSONResponse(warmup_status, status_code=200 if warmup_status["ready"] else 503)
+
+
+@app.get("/printer/status", summary="Printer Connection Status")
+async def printer_status():
+    """
+    返回每台打印机串口的连接状态（disconnected、connecting、connected）、重连次数、
+    排队行数、估计打印速度以及是否在轮换中。
+    """
+    return printer_pool.status()
+
+@app.get("/metrics", summary="Prometheus Metrics")
+async def metrics_endpoint():
+    """
+    以 Prometheus 文本格式导出各处理阶段的耗时直方图、任务计数、队列深度、
+    编码缓存命中情况以及每台打印机的连接状态。
+    """
+    return Response(metrics.render(), media_type=Registry.CONTENT_TYPE)
 
 # --- 运行服务器的说明 ---
 # 要启动服务器，请在终端中运行以下命令：
@@ -1,27 +1,281 @@
-from serial import Serial
-from printer_data import PrinterData
+import math
+import time
+from typing import Iterable, Iterator, Optional, Tuple, Union
+from printer_data import EncodedJob, PrinterData, ROW_FRAME_SIZE
+from printer_connection import PrinterConnection
+from flow_control import FlowController
+from transmission_stats import TransmissionStats
+import utils
 
 # This byte sequence is sent by the printer to indicate the end of a print job.
 PRINT_END_RESPONSE = b'\xaa\xaa\x0d\x01\x30\x00\x80\x01\x00\x00\x00\x00\x00\x01\x34\x01\x55\x55'
 
+# Writing a whole job buffer in slices of this size keeps syscalls few while
+# staying below the RFCOMM tty buffer.
+DEFAULT_CHUNK_SIZE = 4096
+
+
+def acknowledged_row(job: EncodedJob, offset: int, pending_bytes: int, in_flight_rows: float) -> int:
+    """
+    Estimates the row a resumed job can safely restart from, after the first
+    `offset` bytes of the job were written: bytes still queued in the
+    driver and rows the flow controller counts as not yet printed may be
+    lost with the link, so they are sent again.
+    """
+    return max(0, job.rows_before(offset - pending_bytes) - math.ceil(in_flight_rows))
+
+
+def write_ranges(
+    job: EncodedJob, start_row: int, chunk_size: int, flow: Optional[FlowController] = None
+) -> Iterator[Tuple[int, int, int]]:
+    """
+    Yields the `(start, end, rows)` slices of the job buffer to write for a
+    job starting, or resuming, at `start_row`. A resumed job gets the header
+    handshake again before its rows. Without flow control the buffer is cut
+    into `chunk_size` slices; with it, the rows go in batches no larger than
+    the window, and `rows` is how many row frames the caller has to pace
+    before writing the slice. Each batch is sized only when it is asked
+    for, so it follows the window as it changes.
+    """
+    if start_row or flow is not None:
+        yield 0, job.HEADER_SIZE, 0
+        offset = job.row_offset(start_row)
+    else:
+        offset = 0
+
+    if flow is None:
+        while offset < len(job):
+            end = min(offset + chunk_size, len(job))
+            yield offset, end, 0
+            offset = end
+        return
+
+    # A chunk size below one frame gives per-frame pacing.
+    rows_per_chunk = max(1, chunk_size // ROW_FRAME_SIZE)
+    row = start_row
+    while row < job.rows:
+        batch = min(rows_per_chunk, flow.window, job.rows - row)
+        yield job.row_offset(row), job.row_offset(row + batch), batch
+        row += batch
+    yield job.row_offset(job.rows), len(job), 0
+
+
+class JobProgress:
+    """
+    How far the job being sent has got: the last row known to have reached
+    the printer, which is where an attempt after a dropped link restarts,
+    and how many of its `max_resumes` resumes have been used.
+    """
+
+    def __init__(self, job: EncodedJob, max_resumes: int) -> None:
+        self.job = job
+        self.max_resumes = max_resumes
+        self.row = 0
+        self.resumes = 0
+
+    def on_write(self, end: int, pending_bytes: int, in_flight_rows: float) -> None:
+        """Called once the buffer up to offset `end` has been written."""
+        self.row = max(self.row, acknowledged_row(self.job, end, pending_bytes, in_flight_rows))
+
+    def resume(self, error: Exception) -> bool:
+        """
+        Counts a resume after `error`. Returns False once the job has used
+        up its resumes, in which case the caller re-raises the error.
+        """
+        self.resumes += 1
+        if self.resumes > self.max_resumes:
+            return False
+        print(f"{error}; resuming from row {self.row}.")
+        return True
+
+
+class EndOfJobDetector:
+    """
+    Scans the bytes read from the printer for PRINT_END_RESPONSE. Bytes are fed
+    in as they arrive, so a response split across several reads is still found.
+    """
+
+    def __init__(self, pattern: bytes = PRINT_END_RESPONSE) -> None:
+        if not pattern:
+            raise ValueError("pattern must not be empty.")
+        self._pattern = pattern
+        self._tail = b''
+
+    def feed(self, data: bytes) -> int:
+        """Returns how many complete end-of-job responses `data` finished."""
+        buf = self._tail + data
+        found = 0
+        start = buf.find(self._pattern)
+        while start != -1:
+            found += 1
+            buf = buf[start + len(self._pattern):]
+            start = buf.find(self._pattern)
+        # Only a partial response can still complete on the next read.
+        self._tail = buf[max(0, len(buf) - (len(self._pattern) - 1)):]
+        return found
+
+    def reset(self) -> None:
+        self._tail = b''
+
 
 class Printer:
     """
     Manages the connection to the printer and processes a queue of print missions.
     """
 
-    def __init__(self, port: str) -> None:
-        self._rfcomm = Serial(port)
+    def __init__(
+        self,
+        port: Union[str, PrinterConnection],
+        end_timeout: float = 120.0,
+        flow_control: Optional[FlowController] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_resumes: int = 3,
+    ) -> None:
+        # A shared PrinterConnection keeps the port open across jobs; a port
+        # name gets a connection of its own.
+        if isinstance(port, PrinterConnection):
+            self._rfcomm = port
+        else:
+            self._rfcomm = PrinterConnection(port)
+        self._end_timeout = end_timeout
+        # Without a FlowController frames are written as fast as the port takes them.
+        self._flow = flow_control
+        # Bytes handed to the port per write; tune it to the link's buffer size.
+        self._chunk_size = chunk_size
+        self._max_resumes = max_resumes
+        self._detector = EndOfJobDetector()
+        self._progress: Optional[JobProgress] = None
+        self.resumes = 0
+        # Seconds from the first byte of the last job to its end-of-job response.
+        self.last_job_time: Optional[float] = None
+        self.jobs_completed = 0
 
-    def run(self, mission: PrinterData, dry_run=False) -> None:
+    @property
+    def acknowledged_row(self) -> int:
+        """Last row of the current job known to have reached the printer."""
+        return self._progress.row if self._progress is not None else 0
+
+    def run(self, mission: PrinterData, dry_run=False, wait=True, stats: Optional[TransmissionStats] = None) -> None:
         """
-        Starts processing the print queue.
-        This method will run until the queue is empty.
+        Sends one mission to the printer. With `wait`, returns only after the
+        printer has reported the end of every sub-job.
         """
         if dry_run:
             print("Dry run mode: Skipping actual printing.")
             return
 
-        mission_data = mission.get_printer_acceptable_data()
-        for buf in mission_data:
-            self._rfcomm.write(buf)
+        started = time.monotonic()
+        # Jobs taller than the 16-bit row counter are sent as consecutive
+        # sub-jobs, each encoded only when the previous one has been sent.
+        for job in mission.encode_segments():
+            self.send(job, wait=wait, stats=stats)
+
+        if wait:
+            self.last_job_time = time.monotonic() - started
+
+    def send(self, job: EncodedJob, wait=True, stats: Optional[TransmissionStats] = None) -> None:
+        """
+        Writes an encoded job in `chunk_size` slices of its buffer. With flow
+        control, rows are paced in batches no larger than the window.
+        If the link drops, the connection is reopened and the job resumes from
+        the last acknowledged row after a fresh header, up to `max_resumes`
+        times; the rows keep their original indices, so nothing is re-encoded.
+        """
+        started = time.monotonic()
+        if stats is not None:
+            stats.on_job_start(job.rows)
+
+        progress = self._progress = JobProgress(job, self._max_resumes)
+        while True:
+            try:
+                self._send_from(job, progress.row, wait, stats)
+                break
+            except utils.PrinterDisconnectedException as e:
+                if not progress.resume(e):
+                    raise
+                self.resumes += 1
+
+        if wait:
+            if stats is not None:
+                stats.on_end_response()
+            self.last_job_time = time.monotonic() - started
+            self.jobs_completed += 1
+            if self._flow is not None:
+                self._flow.on_job_end(job.rows, self.last_job_time)
+
+    def _send_from(self, job: EncodedJob, start_row: int, wait: bool, stats: Optional[TransmissionStats]) -> None:
+        self._rfcomm.reset_input_buffer()
+        self._detector.reset()
+        if self._flow is not None:
+            self._flow.start()
+
+        for start, end, rows in write_ranges(job, start_row, self._chunk_size, self._flow):
+            if rows:
+                self._flow.acquire(rows)
+            latency = self._write(job, start, end, stats)
+            if rows:
+                self._flow.on_write(latency, rows)
+
+        if wait:
+            self.wait_for_end()
+
+    def _write(self, job: EncodedJob, start: int, end: int, stats: Optional[TransmissionStats]) -> float:
+        """
+        Writes bytes `start` to `end` of the job buffer, advances the
+        acknowledged row and returns how long the write took.
+        """
+        write_started = time.monotonic()
+        self._rfcomm.write_view(memoryview(job.buffer)[start:end])
+        latency = time.monotonic() - write_started
+        rows_sent = job.rows_before(end)
+        if stats is not None:
+            stats.on_write(end - start, latency, rows_sent)
+        in_flight = self._flow.in_flight if self._flow is not None else 0
+        self._progress.on_write(end, self._rfcomm.out_waiting(), in_flight)
+        return latency
+
+    def begin_job(self) -> None:
+        """
+        Prepares for a job whose frames are written piecemeal with
+        write_frames(), e.g. while the rows are still being encoded.
+        """
+        self._rfcomm.reset_input_buffer()
+        self._detector.reset()
+        if self._flow is not None:
+            self._flow.start()
+
+    def write_frames(self, frames, rows: int = 0) -> None:
+        """
+        Writes already framed bytes in `chunk_size` slices. The `rows` row
+        frames among them are paced by the flow controller.
+        """
+        if self._flow is not None and rows:
+            self._flow.acquire(rows)
+        write_started = time.monotonic()
+        view = memoryview(frames)
+        for offset in range(0, len(view), self._chunk_size):
+            self._rfcomm.write_view(view[offset:offset + self._chunk_size])
+        if self._flow is not None and rows:
+            self._flow.on_write(time.monotonic() - write_started, rows)
+
+    def run_queue(self, missions: Iterable[PrinterData]) -> None:
+        """
+        Starts processing the print queue.
+        This method will run until the queue is empty. Each mission is
+        released the moment the printer reports the previous one done.
+        """
+        for mission in missions:
+            self.run(mission)
+
+    def wait_for_end(self, timeout: Optional[float] = None) -> None:
+        """
+        Blocks until the printer sends PRINT_END_RESPONSE, raising
+        PrintTimeoutException if it does not arrive within `timeout` seconds.
+        """
+        timeout = self._end_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = self._rfcomm.read_available()
+            if data and self._detector.feed(data):
+                return
+        raise utils.PrintTimeoutException(timeout)
@@ -0,0 +1,200 @@
+import os
+import select
+import threading
+import time
+from enum import Enum
+from typing import Optional
+
+from serial import Serial, SerialException
+
+import utils
+
+
+class ConnectionState(str, Enum):
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+
+
+class PrinterConnection:
+    """
+    Owns the serial port of one printer for the lifetime of the process.
+    The port is opened on first use and kept open between jobs. When the
+    Bluetooth link drops, the port is closed and reopened with exponential
+    backoff the next time it is needed.
+    """
+
+    def __init__(
+        self,
+        port: str,
+        timeout: float = 1.0,
+        backoff_initial: float = 0.5,
+        backoff_max: float = 30.0,
+        max_attempts: Optional[int] = 5,
+    ) -> None:
+        self.port = port
+        self._timeout = timeout
+        self._backoff_initial = backoff_initial
+        self._backoff_max = backoff_max
+        self._max_attempts = max_attempts
+        self._serial: Optional[Serial] = None
+        self._lock = threading.RLock()
+        self.state = ConnectionState.DISCONNECTED
+        self.last_error: Optional[str] = None
+        self.reconnects = 0
+        self.connected_since: Optional[float] = None
+
+    def connect(self) -> Serial:
+        """
+        Returns the open port, opening it first if needed. Retries with
+        exponential backoff and raises PrinterDisconnectedException once
+        `max_attempts` attempts have failed.
+        """
+        with self._lock:
+            if self._serial is not None and self._serial.is_open:
+                return self._serial
+
+            self.state = ConnectionState.CONNECTING
+            delay = self._backoff_initial
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    self._serial = Serial(self.port, timeout=self._timeout)
+                except (SerialException, OSError) as e:
+                    self.last_error = str(e)
+                    if self._max_attempts is not None and attempt >= self._max_attempts:
+                        self.state = ConnectionState.DISCONNECTED
+                        raise utils.PrinterDisconnectedException(self.port, self.last_error) from e
+                    print(f"Could not open {self.port} ({e}), retrying in {delay:.1f}s.")
+                    time.sleep(delay)
+                    delay = min(delay * 2, self._backoff_max)
+                    continue
+
+                if self.connected_since is not None:
+                    self.reconnects += 1
+                self.state = ConnectionState.CONNECTED
+                self.connected_since = time.time()
+                self.last_error = None
+                return self._serial
+
+    def drop(self, error: Exception) -> None:
+        """Forgets a port whose link has gone away, so the next use reopens it."""
+        with self._lock:
+            self.last_error = str(error)
+            self.state = ConnectionState.DISCONNECTED
+            if self._serial is not None:
+                try:
+                    self._serial.close()
+                except (SerialException, OSError):
+                    pass
+                self._serial = None
+
+    def write(self, data) -> int:
+        serial = self.connect()
+        try:
+            return serial.write(data)
+        except (SerialException, OSError) as e:
+            self.drop(e)
+            raise utils.PrinterDisconnectedException(self.port, str(e)) from e
+
+    def write_view(self, view: memoryview) -> None:
+        """
+        Writes a slice of a job buffer straight to the port's file descriptor,
+        skipping the copy pyserial makes of every buffer it is given. Falls
+        back to Serial.write on platforms without a file descriptor.
+        """
+        serial = self.connect()
+        try:
+            fd = serial.fileno()
+        except (AttributeError, SerialException):
+            self.write(view)
+            return
+
+        try:
+            while view:
+                try:
+                    written = os.write(fd, view)
+                except BlockingIOError:
+                    # pyserial opens the port non-blocking; wait until it drains.
+                    select.select([], [fd], [])
+                    continue
+                view = view[written:]
+        except OSError as e:
+            self.drop(e)
+            raise utils.PrinterDisconnectedException(self.port, str(e)) from e
+
+    def read(self, size: int = 1) -> bytes:
+        serial = self.connect()
+        try:
+            return serial.read(size)
+        except (SerialException, OSError) as e:
+            self.drop(e)
+            raise utils.PrinterDisconnectedException(self.port, str(e)) from e
+
+    def read_available(self) -> bytes:
+        """
+        Waits up to the port timeout for at least one byte, then returns it
+        together with everything else already buffered.
+        """
+        serial = self.connect()
+        try:
+            data = serial.read(1)
+            if data and serial.in_waiting:
+                data += serial.read(serial.in_waiting)
+            return data
+        except (SerialException, OSError) as e:
+            self.drop(e)
+            raise utils.PrinterDisconnectedException(self.port, str(e)) from e
+
+    def out_waiting(self) -> int:
+        """Bytes written but still queued in the driver, 0 if unknown."""
+        serial = self._serial
+        if serial is None:
+            return 0
+        try:
+            return serial.out_waiting
+        except (SerialException, OSError, NotImplementedError):
+            return 0
+
+    def reset_input_buffer(self) -> None:
+        """Discards bytes the printer sent before the current job started."""
+        serial = self.connect()
+        try:
+            serial.reset_input_buffer()
+        except (SerialException, OSError) as e:
+            self.drop(e)
+            raise utils.PrinterDisconnectedException(self.port, str(e)) from e
+
+    def flush(self) -> None:
+        serial = self.connect()
+        try:
+            serial.flush()
+        except (SerialException, OSError) as e:
+            self.drop(e)
+            raise utils.PrinterDisconnectedException(self.port, str(e)) from e
+
+    def close(self) -> None:
+        with self._lock:
+            if self._serial is not None:
+                self._serial.close()
+                self._serial = None
+            self.state = ConnectionState.DISCONNECTED
+            self.connected_since = None
+
+    def status(self) -> dict:
+        """Reports the connection state, e.g. for a health endpoint."""
+        return {
+            "port": self.port,
+            "state": self.state.value,
+            "connected_since": self.connected_since,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+        }
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,11 +1,53 @@
 import utils
 import cv2
-from typing import List
+from typing import Iterable, Iterator, List
 from char import CHAR_BITMAPS
-from process_image_to_packets import process_image_to_packets
+from process_image_to_packets import iter_image_packets, process_image_to_packets
 from PIL import Image, ImageDraw, ImageFont
-import tempfile
-import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+
+# Every row frame carries its index as a 16-bit little-endian counter, so a
+# single job can address at most this many rows.
+MAX_ROWS_PER_JOB = 0x10000
+
+# Row frames start with the sync bytes, the frame length and command 0x03.
+ROW_FRAME_PREFIX = b'\xaa\xaa\x34\x03'
+# Prefix, 16-bit row index, row count, 48 bytes of pixels and the UU trailer.
+ROW_FRAME_SIZE = len(ROW_FRAME_PREFIX) + 3 + 48 + 2
+
+# Printer command prefix/header
+JOB_HEADER = (
+    b'\xaa\xaa\x01\x01UU',
+    b'\xaa\xaa\x01\xacUU',
+    b'\xaa\xaa\x01\xacUU',
+    b'\xaa\xaa\x01\x04UU',
+    b'\xaa\xaa\x01\x01UU',
+    b'\xaa\xaa\x08\x02\xb6\x00\x00\x00\x00\x01\x1bUU',
+)
+
+# Printer command suffix/footer
+JOB_FOOTER = (
+    b'\xaa\xaa\x01\x01UU',
+    b'\xaa\xaa\x01\x01UU',
+)
+
+# Font used by PrinterData.from_string.
+TEXT_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
+TEXT_FONT_SIZE = 24
+
+
+@lru_cache(maxsize=None)
+def load_font(font_path: str = TEXT_FONT_PATH, font_size: int = TEXT_FONT_SIZE):
+    """
+    Loads a TrueType font, falling back to Pillow's default font. Fonts are
+    loaded once per process and reused by every later call.
+    """
+    try:
+        return ImageFont.truetype(font_path, font_size)
+    except IOError:
+        return ImageFont.load_default()
 
 
 def _wrap_text_force_break(text, font, max_width):
@@ -34,6 +76,237 @@ def _wrap_text_force_break(text, font, max_width):
     return lines
 
 
+def prepare_image(image):
+    """
+    Rotates and resizes a grayscale image to the printer's 384 pixel width.
+    Raises ValueError for a missing (e.g. undecodable), empty or
+    non-grayscale image.
+    """
+    if image is None or getattr(image, "size", 0) == 0:
+        raise ValueError("Image is empty or could not be decoded.")
+    if image.ndim != 2:
+        raise ValueError(f"Expected a grayscale image, got an array of shape {image.shape}.")
+    height, width = image.shape
+
+    # If the image is wider than it is tall, rotate it.
+    if width > height:
+        print("Image is wider than tall, rotating 90 degrees.")
+        image = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        height, width = image.shape
+
+    # The printer's width is 384 pixels, which is 48 bytes.
+    # If the image width is not 384, it should be resized.
+    if width != 384:
+        print(f"Image width is {width}, resizing to 384.")
+        aspect_ratio = height / width
+        new_height = int(384 * aspect_ratio)
+        image = cv2.resize(image, (384, new_height))
+
+    return image
+
+
+def fit_width(image: np.ndarray, width: int = 384) -> np.ndarray:
+    """
+    Pads a grayscale image with white on the right, or crops it, to exactly
+    `width` pixels, without rotating or scaling it.
+    """
+    height, current = image.shape
+    if current >= width:
+        return image[:, :width]
+    padded = np.full((height, width), 255, np.uint8)
+    padded[:, :current] = image
+    return padded
+
+
+def render_text(text: str, max_width: int = 384) -> np.ndarray:
+    """
+    Renders a string into a grayscale image with lines wrapped at
+    `max_width` pixels and 10 pixels of padding on each side. This is the
+    image PrinterData.from_string encodes; its width is that of the longest
+    line, so it still has to be fitted to the printer.
+    """
+    font = load_font()
+
+    # Wrap text to fit printer width (384px)
+    text = text.replace('\n', ' ')
+    wrapped_text = _wrap_text_force_break(text, font, max_width)
+
+    # Calculate image dimensions
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    max_line_width = 0
+    total_height = 0
+    line_spacing = 5
+    line_heights = []
+
+    for line in wrapped_text:
+        try:
+            # Pillow >= 10.0.0
+            bbox = draw.textbbox((0, 0), line, font=font)
+            line_width = bbox[2] - bbox[0]
+            line_height = bbox[3] - bbox[1]
+        except AttributeError:
+            # Older Pillow
+            line_width, line_height = draw.textsize(line, font=font)
+
+        if line_width > max_line_width:
+            max_line_width = line_width
+        line_heights.append(line_height)
+        total_height += line_height + line_spacing
+
+    img_width = max_line_width + 20 # Add padding
+    img_height = total_height + 10 # Add padding
+
+    img = Image.new('L', (img_width, img_height), color='white')
+    draw = ImageDraw.Draw(img)
+
+    y_text = 5
+    for line, line_height in zip(wrapped_text, line_heights):
+        draw.text((10, y_text), line, font=font, fill='black')
+        y_text += line_height + line_spacing
+
+    return np.asarray(img)
+
+
+def append_row_frame(buffer: bytearray, index: int, pieces) -> None:
+    """
+    Appends the frame of row `index` to `buffer`. `pieces` hold the row's
+    48 bytes of pixels, e.g. a canvas row of single-byte lists, or a
+    one-element tuple with a whole packet.
+    """
+    buffer += ROW_FRAME_PREFIX
+    buffer.append(index & 0xFF)
+    buffer.append((index >> 8) & 0xFF)
+    buffer.append(1)
+    for v in pieces:
+        buffer.extend(v)
+    buffer += b'UU'
+
+
+def _encode_frame(image, dithering: bool = True) -> List[bytes]:
+    """
+    Turns one grayscale frame into printer packets. Kept at module level so it
+    can be sent to worker processes.
+    """
+    return process_image_to_packets(prepare_image(image), dithering=dithering)
+
+
+class EncodedJob:
+    """
+    A framed job held in one contiguous buffer: the header frames, one
+    fixed-size frame per row, then the footer frames. Transports send it in
+    large memoryview slices and can find any row frame by its offset.
+    """
+
+    HEADER_SIZE = sum(len(item) for item in JOB_HEADER)
+    FOOTER_SIZE = sum(len(item) for item in JOB_FOOTER)
+
+    def __init__(self, buffer: bytearray, rows: int) -> None:
+        self.buffer = buffer
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def row_offset(self, row: int) -> int:
+        return self.HEADER_SIZE + row * ROW_FRAME_SIZE
+
+    def rows_before(self, offset: int) -> int:
+        """Number of row frames that end at or before byte `offset`."""
+        return min(self.rows, max(0, (offset - self.HEADER_SIZE) // ROW_FRAME_SIZE))
+
+    def header(self) -> memoryview:
+        return memoryview(self.buffer)[:self.HEADER_SIZE]
+
+    def footer(self) -> memoryview:
+        return memoryview(self.buffer)[self.row_offset(self.rows):]
+
+    def bitplane(self) -> np.ndarray:
+        """
+        The packed pixels of every row as a (rows, 48) uint8 array, a view
+        into the frames; set bits are black dots.
+        """
+        frames = np.frombuffer(self.buffer, np.uint8, self.rows * ROW_FRAME_SIZE, self.HEADER_SIZE)
+        pixels = len(ROW_FRAME_PREFIX) + 3
+        return frames.reshape(self.rows, ROW_FRAME_SIZE)[:, pixels:pixels + 48]
+
+    @staticmethod
+    def concat(jobs: List['EncodedJob']) -> List['EncodedJob']:
+        """
+        Joins the rows of several encoded jobs so they print back to back
+        with a single header and footer, split into as few jobs of at most
+        MAX_ROWS_PER_JOB rows as possible. Row frames are copied whole and
+        only their row indices are rewritten.
+        """
+        if not jobs:
+            return []
+        frames = np.concatenate([
+            np.frombuffer(job.buffer, np.uint8, job.rows * ROW_FRAME_SIZE, job.HEADER_SIZE) for job in jobs
+        ]).reshape(-1, ROW_FRAME_SIZE)
+
+        joined = []
+        index_offset = len(ROW_FRAME_PREFIX)
+        for start in range(0, len(frames), MAX_ROWS_PER_JOB):
+            part = frames[start:start + MAX_ROWS_PER_JOB]
+            rows = len(part)
+            buffer = bytearray(EncodedJob.HEADER_SIZE + rows * ROW_FRAME_SIZE)
+            buffer[:EncodedJob.HEADER_SIZE] = b''.join(JOB_HEADER)
+            buffer += b''.join(JOB_FOOTER)
+            out = np.frombuffer(buffer, np.uint8, rows * ROW_FRAME_SIZE, EncodedJob.HEADER_SIZE)
+            out = out.reshape(rows, ROW_FRAME_SIZE)
+            out[:] = part
+            index = np.arange(rows)
+            out[:, index_offset] = index & 0xFF
+            out[:, index_offset + 1] = index >> 8
+            del out
+            joined.append(EncodedJob(buffer, rows))
+        return joined
+
+
+def encode_packets(packets: Iterable[bytes]) -> Iterator[EncodedJob]:
+    """
+    Frames the packets returned by process_image_to_packets straight into
+    encoded jobs of at most MAX_ROWS_PER_JOB rows, without building a
+    PrinterData canvas first. Packets may come from a generator such as
+    iter_image_packets; each job is yielded as soon as its last row arrives.
+    """
+    buffer = None
+    rows = 0
+    for packet in packets:
+        if buffer is None:
+            buffer = bytearray()
+            for item in JOB_HEADER:
+                buffer += item
+        append_row_frame(buffer, rows, (packet,))
+        rows += 1
+        if rows == MAX_ROWS_PER_JOB:
+            yield _close_job(buffer, rows)
+            buffer, rows = None, 0
+    if buffer is not None:
+        yield _close_job(buffer, rows)
+
+
+def _close_job(buffer: bytearray, rows: int) -> EncodedJob:
+    for item in JOB_FOOTER:
+        buffer += item
+    return EncodedJob(buffer, rows)
+
+
+def encode_image_segments(frames, dithering: bool = True) -> Iterator[EncodedJob]:
+    """
+    Rotates, resizes, dithers and frames a grayscale image, or several
+    frames printed back to back, one sub-job at a time. Rows are dithered
+    only when the sub-job they belong to is encoded, so a tall image never
+    exists as a whole canvas of rows; error diffusion still runs across
+    sub-job boundaries.
+    """
+    if frames is None or isinstance(frames, np.ndarray):
+        frames = [frames]
+    frames = [prepare_image(frame) for frame in frames]
+    return encode_packets(
+        packet for frame in frames for packet in iter_image_packets(frame, dithering=dithering)
+    )
+
+
 class PrinterData:
     """
     Represents the printer's canvas and provides methods to draw text and
@@ -46,6 +319,11 @@ class PrinterData:
         self._cursor_y = 0
         self.data_array = self._create_empty_canvas()
 
+    @property
+    def height(self) -> int:
+        """Number of rows on the canvas."""
+        return self._height
+
     def _create_empty_canvas(self):
         """Creates a blank data array (canvas) of the specified height."""
         return [[[0] for _ in range(48)] for _ in range(self._height)]
@@ -91,28 +369,37 @@ class PrinterData:
             self._cursor_y += char_shape[0]
 
 
-    def get_printer_acceptable_data(self) -> List[bytes]:
+    def segments(self, max_rows: int = MAX_ROWS_PER_JOB) -> Iterator['PrinterData']:
         """
-        Assembles the complete data payload with headers, canvas data, and footers
-        in a format the printer can understand.
+        Splits the canvas into consecutive sub-jobs of at most `max_rows` rows.
+        Each sub-job shares the row data of this canvas instead of copying it.
         """
-        count = 0
-
-        # Printer command prefix/header
-        header = [
-            b'\xaa\xaa\x01\x01UU',
-            b'\xaa\xaa\x01\xacUU',
-            b'\xaa\xaa\x01\xacUU',
-            b'\xaa\xaa\x01\x04UU',
-            b'\xaa\xaa\x01\x01UU',
-            b'\xaa\xaa\x08\x02\xb6\x00\x00\x00\x00\x01\x1bUU',
-        ]
+        if max_rows < 1:
+            raise ValueError("max_rows must be positive.")
+
+        for start in range(0, self._height, max_rows):
+            end = min(start + max_rows, self._height)
+            segment = PrinterData.__new__(PrinterData)
+            segment._height = end - start
+            segment._cursor_x = 4
+            segment._cursor_y = 0
+            segment.data_array = self.data_array[start:end]
+            yield segment
+
+    def iter_printer_acceptable_data(self) -> Iterator[bytes]:
+        """
+        Yields the header, row frames and footer one frame at a time, so a job
+        can be streamed without building the whole payload first.
+        """
+        if self._height > MAX_ROWS_PER_JOB:
+            raise utils.TooManyRowsException
 
-        buffer = [bytes(item) for item in header]
+        for item in JOB_HEADER:
+            yield bytes(item)
 
         for i in range(self._height):
             line = bytearray()
-            line.extend(b'\xaa\xaa\x34\x03')
+            line.extend(ROW_FRAME_PREFIX)
             line.append(i & 0xFF)
             line.append((i >> 8) & 0xFF)
             line.append(1)
@@ -121,87 +408,60 @@ class PrinterData:
                 line.extend(bytes(v))
 
             line.extend(b'UU')
-            buffer.append(bytes(line))
+            yield bytes(line)
 
-        # Printer command suffix/footer
-        footer = [
-            b'\xaa\xaa\x01\x01UU',
-            b'\xaa\xaa\x01\x01UU',
-        ]
-        buffer.extend(footer)
+        yield from JOB_FOOTER
 
-        return buffer
+    def get_printer_acceptable_data(self) -> List[bytes]:
+        """
+        Assembles the complete data payload with headers, canvas data, and footers
+        in a format the printer can understand.
+        Jobs taller than MAX_ROWS_PER_JOB must be sent through `segments()`.
+        """
+        return list(self.iter_printer_acceptable_data())
 
-    @staticmethod
-    def from_string(text: str, debug_output = False):
+    def encode(self) -> 'EncodedJob':
         """
-        Generates an image containing the given string and processes it.
+        Frames the whole job into one contiguous buffer, without creating an
+        intermediate bytes object per frame.
         """
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
-        font_size = 24
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-        except IOError:
-            font = ImageFont.load_default()
+        if self._height > MAX_ROWS_PER_JOB:
+            raise utils.TooManyRowsException
 
-        # Wrap text to fit printer width (384px)
-        text = text.replace('\n', ' ')
-        wrapped_text = _wrap_text_force_break(text, font, 384)
-        
-        # Calculate image dimensions
-        draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
-        max_line_width = 0
-        total_height = 0
-        line_spacing = 5
-
-        for line in wrapped_text:
-            try:
-                # Pillow >= 10.0.0
-                bbox = draw.textbbox((0, 0), line, font=font)
-                line_width = bbox[2] - bbox[0]
-                line_height = bbox[3] - bbox[1]
-            except AttributeError:
-                # Older Pillow
-                line_width, line_height = draw.textsize(line, font=font)
-            
-            if line_width > max_line_width:
-                max_line_width = line_width
-            total_height += line_height + line_spacing
-            
-        img_width = max_line_width + 20 # Add padding
-        img_height = total_height + 10 # Add padding
+        buffer = bytearray()
+        for item in JOB_HEADER:
+            buffer += item
 
-        img = Image.new('L', (img_width, img_height), color='white')
-        draw = ImageDraw.Draw(img)
+        for i in range(self._height):
+            # Rows hold single-byte lists or bytes, both of which extend in place.
+            append_row_frame(buffer, i, self.data_array[i])
 
-        y_text = 5 #
-        for line in wrapped_text:
-            try:
-                # Pillow >= 10.0.0
-                bbox = draw.textbbox((0, 0), line, font=font)
-                line_height = bbox[3] - bbox[1]
-            except AttributeError:
-                # Older Pillow
-                _, line_height = draw.textsize(line, font=font)
+        for item in JOB_FOOTER:
+            buffer += item
 
-            draw.text((10, y_text), line, font=font, fill='black')
-            y_text += line_height + line_spacing
+        return EncodedJob(buffer, self._height)
 
+    def encode_segments(self) -> Iterator['EncodedJob']:
+        """
+        Encodes the job one sub-job at a time, see `segments()`. The rows
+        themselves are already on the canvas; to avoid holding a tall image
+        as a canvas, encode it with encode_image_segments() instead.
+        """
+        for segment in self.segments():
+            yield segment.encode()
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        img.save(temp_file.name)
+    @staticmethod
+    def from_string(text: str, debug_output = False, dithering: bool = True):
+        """
+        Generates an image containing the given string and processes it.
+        The image is rendered in memory; pass `dithering=False` for plain
+        black and white text, which encodes much faster.
+        """
+        image = render_text(text)
         if debug_output:
-            img.save("debug_output.png")
+            cv2.imwrite("debug_output.png", image)
 
-        # from_image expects a path, so we close the file and pass the name
-        temp_file.close()
-
-        try:
-            printer_data = PrinterData.from_image(temp_file.name)
-        finally:
-            os.unlink(temp_file.name)
-
-        return printer_data
+        return PrinterData.from_packets(_encode_frame(image, dithering))
 
     @staticmethod
     def from_image(image_path: str, dithering: bool = True):
@@ -213,26 +473,39 @@ class PrinterData:
         if image is None:
             raise FileNotFoundError(f"Image not found at {image_path}")
 
-        height, width = image.shape
+        return PrinterData.from_packets(_encode_frame(image, dithering))
 
-        # If the image is wider than it is tall, rotate it.
-        if width > height:
-            print("Image is wider than tall, rotating 90 degrees.")
-            image = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
-            height, width = image.shape
+    @staticmethod
+    def from_image_frames(image_path: str, dithering: bool = True, max_workers=None) -> List['PrinterData']:
+        """
+        Creates one PrinterData object per frame of a multi-frame image such as
+        an animated GIF or a multi-page TIFF. Frames are encoded in parallel
+        worker processes, since dithering is pure Python and bound by the GIL.
+        """
+        ok, frames = cv2.imreadmulti(image_path, flags=cv2.IMREAD_GRAYSCALE)
+        if not ok or not frames:
+            raise FileNotFoundError(f"Image not found at {image_path}")
 
-        # The printer's width is 384 pixels, which is 48 bytes.
-        # If the image width is not 384, it should be resized.
-        if width != 384:
-            print(f"Image width is {width}, resizing to 384.")
-            aspect_ratio = height / width
-            new_height = int(384 * aspect_ratio)
-            image = cv2.resize(image, (384, new_height))
+        if len(frames) == 1 or max_workers == 1:
+            packet_lists = [_encode_frame(frame, dithering) for frame in frames]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                packet_lists = list(executor.map(_encode_frame, frames, [dithering] * len(frames)))
 
-        packets = process_image_to_packets(image, dithering=dithering)
+        return [PrinterData.from_packets(packets) for packets in packet_lists]
 
+    @staticmethod
+    def from_packets(packets: List[bytes]):
+        """
+        Creates a PrinterData object from the packets returned by
+        process_image_to_packets.
+        """
         # The height of the printer data should match the number of packets.
-        printer_data = PrinterData(height=len(packets))
+        # The canvas is replaced below, so skip allocating an empty one.
+        printer_data = PrinterData.__new__(PrinterData)
+        printer_data._height = len(packets)
+        printer_data._cursor_x = 4
+        printer_data._cursor_y = 0
 
         new_data_array = []
         for packet in packets:
@@ -244,3 +517,15 @@ class PrinterData:
         printer_data.data_array = new_data_array
 
         return printer_data
+
+    @staticmethod
+    def concat(parts: List['PrinterData']):
+        """
+        Joins several PrinterData objects into one job, so they are printed
+        back to back with a single header and footer.
+        """
+        printer_data = PrinterData(height=0)
+        for part in parts:
+            printer_data.data_array.extend(part.data_array)
+        printer_data._height = len(printer_data.data_array)
+        return printer_data
@@ -0,0 +1,125 @@
+import time
+from typing import List, Optional
+
+from async_printer import AsyncPrinter
+from flow_control import DEFAULT_ROWS_PER_SECOND, FlowController
+from printer_connection import PrinterConnection
+from printer_data import EncodedJob, PrinterData
+from transmission_stats import TransmissionStats
+import utils
+
+
+class PooledPrinter:
+    """One printer of a PrinterPool, with the load and health the pool dispatches on."""
+
+    def __init__(
+        self,
+        port: str,
+        flow_window: int = 128,
+        rows_per_second: float = DEFAULT_ROWS_PER_SECOND,
+        **printer_options,
+    ) -> None:
+        self.port = port
+        self.connection = PrinterConnection(port)
+        self.flow = FlowController(window=flow_window, rows_per_second=rows_per_second)
+        self.printer = AsyncPrinter(self.connection, flow_control=self.flow, **printer_options)
+        # Rows assigned to this printer that have not finished printing yet.
+        self.queued_rows = 0
+        self.failures = 0
+        self.out_of_rotation_until = 0.0
+
+    def in_rotation(self, now: float) -> bool:
+        return now >= self.out_of_rotation_until
+
+    def estimated_finish(self, rows: int) -> float:
+        """Seconds until a job of `rows` rows would be printed on this printer."""
+        return (self.queued_rows + rows) / self.flow.rows_per_second
+
+    def status(self) -> dict:
+        status = self.connection.status()
+        status.update({
+            "queued_rows": self.queued_rows,
+            "rows_per_second": self.flow.rows_per_second,
+            "failures": self.failures,
+            "in_rotation": self.in_rotation(time.monotonic()),
+            "jobs_completed": self.printer.jobs_completed,
+        })
+        return status
+
+
+class PrinterPool:
+    """
+    Dispatches jobs across several printers. Each job goes to the printer in
+    rotation that would finish it first, judged by the rows already queued
+    on it and its measured head speed, so idle printers are used before busy
+    ones and faster printers take more work. A printer that fails
+    `failure_threshold` jobs in a row is taken out of rotation for
+    `cooldown` seconds.
+    """
+
+    def __init__(
+        self,
+        ports: List[str],
+        flow_window: int = 128,
+        rows_per_second: float = DEFAULT_ROWS_PER_SECOND,
+        failure_threshold: int = 3,
+        cooldown: float = 60.0,
+        **printer_options,
+    ) -> None:
+        self.members = [PooledPrinter(port, flow_window, rows_per_second, **printer_options) for port in ports]
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+
+    def connect(self) -> None:
+        """Opens every port once, reporting printers that are not reachable."""
+        for member in self.members:
+            try:
+                member.connection.connect()
+                print(f"Printer connected on port: {member.port}")
+            except utils.PrinterDisconnectedException as e:
+                # Jobs reconnect later, so an unreachable printer is not fatal here.
+                print(f"Printer not available at startup: {e}")
+
+    def close(self) -> None:
+        for member in self.members:
+            member.connection.close()
+
+    def choose(self, rows: int) -> PooledPrinter:
+        now = time.monotonic()
+        candidates = [member for member in self.members if member.in_rotation(now)]
+        if not candidates:
+            raise utils.NoPrinterAvailableException
+        return min(candidates, key=lambda member: member.estimated_finish(rows))
+
+    async def run(self, mission: PrinterData, stats: Optional[TransmissionStats] = None) -> PooledPrinter:
+        """Prints a mission on the chosen printer and returns that printer."""
+        member = self.choose(mission.height)
+        await self._dispatch(member, mission.height, mission.encode_segments(), stats)
+        return member
+
+    async def send(self, jobs: List[EncodedJob], stats: Optional[TransmissionStats] = None) -> PooledPrinter:
+        """Like run(), for jobs that are already encoded."""
+        rows = sum(job.rows for job in jobs)
+        member = self.choose(rows)
+        await self._dispatch(member, rows, jobs, stats)
+        return member
+
+    async def _dispatch(self, member: PooledPrinter, rows: int, jobs, stats) -> None:
+        member.queued_rows += rows
+        try:
+            for job in jobs:
+                await member.printer.send(job, stats)
+        except (utils.PrinterDisconnectedException, utils.PrintTimeoutException):
+            member.failures += 1
+            if member.failures >= self._failure_threshold:
+                print(f"Taking printer on {member.port} out of rotation for {self._cooldown:.0f}s.")
+                member.out_of_rotation_until = time.monotonic() + self._cooldown
+                member.failures = 0
+            raise
+        else:
+            member.failures = 0
+        finally:
+            member.queued_rows -= rows
+
+    def status(self) -> List[dict]:
+        return [member.status() for member in self.members]
@@ -0,0 +1,126 @@
+import pytest
+
+from printer import PRINT_END_RESPONSE, EndOfJobDetector, Printer
+from printer_connection import PrinterConnection
+from printer_data import ROW_FRAME_PREFIX, ROW_FRAME_SIZE, EncodedJob, PrinterData
+import utils
+
+
+class FlakyConnection(PrinterConnection):
+    """
+    Records the bytes of every attempt and drops the link at the given write
+    calls. `pending_bytes` is what the driver reports as not yet sent.
+    """
+
+    def __init__(self, fail_at, pending_bytes: int = 0) -> None:
+        super().__init__("/dev/null")
+        self.fail_at = set(fail_at)
+        self.pending_bytes = pending_bytes
+        self.attempts = [bytearray()]
+        self.writes = 0
+
+    def write_view(self, view) -> None:
+        self.writes += 1
+        if self.writes in self.fail_at:
+            self.attempts.append(bytearray())
+            raise utils.PrinterDisconnectedException(self.port, "link lost")
+        self.attempts[-1] += view
+
+    def out_waiting(self) -> int:
+        return self.pending_bytes
+
+    def reset_input_buffer(self) -> None:
+        pass
+
+    def read_available(self) -> bytes:
+        return PRINT_END_RESPONSE
+
+
+def sent_rows(data: bytes) -> list:
+    """Row indices of the complete row frames after the header."""
+    rows = []
+    offset = EncodedJob.HEADER_SIZE
+    while data.startswith(ROW_FRAME_PREFIX, offset) and offset + ROW_FRAME_SIZE <= len(data):
+        rows.append(data[offset + 4] | (data[offset + 5] << 8))
+        offset += ROW_FRAME_SIZE
+    return rows
+
+
+def make_job(rows: int) -> EncodedJob:
+    return PrinterData.from_packets([bytes(48)] * rows).encode()
+
+
+def test_resume_after_link_drop_mid_job():
+    job = make_job(100)
+    chunk_size = 10 * ROW_FRAME_SIZE
+    pending_bytes = 2 * ROW_FRAME_SIZE
+    # The fourth write fails, after three chunks have gone out.
+    connection = FlakyConnection(fail_at=[4], pending_bytes=pending_bytes)
+    printer = Printer(connection, chunk_size=chunk_size)
+
+    printer.send(job)
+
+    first, second = (bytes(data) for data in connection.attempts)
+    written = 3 * chunk_size
+    # Rows still queued in the driver when the link dropped are sent again.
+    resume_row = job.rows_before(written - pending_bytes)
+    assert printer.resumes == 1
+    assert sent_rows(second)[0] == resume_row
+    assert sent_rows(first) + sent_rows(second)[job.rows_before(written) - resume_row:] == list(range(job.rows))
+    assert job.rows_before(written) - resume_row <= pending_bytes // ROW_FRAME_SIZE
+    assert second.endswith(bytes(job.footer()))
+
+
+def test_resume_keeps_acknowledged_row_across_attempts():
+    job = make_job(100)
+    connection = FlakyConnection(fail_at=[4, 6])
+    printer = Printer(connection, chunk_size=10 * ROW_FRAME_SIZE)
+
+    printer.send(job)
+
+    rows = [sent_rows(bytes(data)) for data in connection.attempts]
+    assert printer.resumes == 2
+    # Nothing is pending in the driver, so no row is sent twice.
+    assert rows[0] + rows[1] + rows[2] == list(range(job.rows))
+
+
+def test_gives_up_after_max_resumes():
+    connection = FlakyConnection(fail_at=[2, 3, 4])
+    printer = Printer(connection, chunk_size=10 * ROW_FRAME_SIZE, max_resumes=2)
+
+    with pytest.raises(utils.PrinterDisconnectedException):
+        printer.send(make_job(100))
+    assert printer.resumes == 2
+
+
+@pytest.mark.parametrize("split", range(1, len(PRINT_END_RESPONSE)))
+def test_end_of_job_detector_finds_split_response(split):
+    detector = EndOfJobDetector()
+    assert detector.feed(b'\x00\x01' + PRINT_END_RESPONSE[:split]) == 0
+    assert detector.feed(PRINT_END_RESPONSE[split:] + b'\x02') == 1
+    assert detector.feed(b'') == 0
+
+
+def test_end_of_job_detector_byte_by_byte():
+    detector = EndOfJobDetector()
+    data = PRINT_END_RESPONSE * 2
+    assert sum(detector.feed(data[i:i + 1]) for i in range(len(data))) == 2
+
+
+@pytest.mark.parametrize("pattern", [b'\x55', b'\x55\xaa', b'\xaa\xaa\x55'])
+def test_end_of_job_detector_short_patterns(pattern):
+    for split in range(len(pattern) + 1):
+        detector = EndOfJobDetector(pattern)
+        assert detector.feed(b'\x00' + pattern[:split]) == (1 if split == len(pattern) else 0)
+        assert detector.feed(pattern[split:] + b'\x00') == (1 if split < len(pattern) else 0)
+        # Bytes already matched are not counted again.
+        assert detector.feed(b'\x00') == 0
+        # Only a possible partial response is carried over to the next read.
+        detector.feed(bytes(4096))
+        assert len(detector._tail) == len(pattern) - 1
+    assert EndOfJobDetector(b'\x55').feed(b'\x55\x00\x55\x55') == 3
+
+
+def test_end_of_job_detector_rejects_empty_pattern():
+    with pytest.raises(ValueError):
+        EndOfJobDetector(b'')
@@ -1,6 +1,6 @@
 import cv2
 import numpy as np
-from typing import List
+from typing import Iterator, List
 
 def process_image_to_packets(
     image: np.ndarray,
@@ -19,19 +19,40 @@ def process_image_to_packets(
     Returns:
         List[bytes]: 一个列表，每个元素都是一个数据包（bytes 对象）。
     """
+    return list(iter_image_packets(image, padding_height, dithering))
+
+
+def iter_image_packets(
+    image: np.ndarray,
+    padding_height: int = 32,
+    dithering: bool = True
+) -> Iterator[bytes]:
+    """
+    与 process_image_to_packets 相同，但逐行生成数据包，
+    这样调用方可以在整幅图像处理完之前就开始发送已完成的行。
+    """
     # 1. 准备工作：转换为灰度图并创建浮点型副本用于抖动处理
     if len(image.shape) == 3 and image.shape[2] == 3: # BGR to Gray
         gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     else:
         gray_image = image.copy()
 
+    # 不抖动时每个像素独立二值化（黑色为1），整幅图像可以一次向量化处理，
+    # 每8个像素按高位在前打包成一个字节，与下面的逐像素结果完全相同。
+    if not dithering:
+        packed = np.packbits(gray_image <= 127, axis=1)
+        for row in packed:
+            yield row.tobytes()
+        blank = bytes((gray_image.shape[1] + 7) // 8)
+        for _ in range(padding_height):
+            yield blank
+        return
+
     # 使用浮点型来精确计算和扩散误差
     dither_image = gray_image.astype(np.float32)
     h, w = dither_image.shape
     total_height = h + padding_height
 
-    packets = []
-
     # 2. 核心处理循环：遍历每个像素
     for y in range(total_height):
         # 如果当前行在实际图像范围内
@@ -86,11 +107,9 @@ def process_image_to_packets(
         # byte[3] = 包内有效行数 (这里简化为1，即每行一个包)
         # header = [3, y & 0xFF, (y >> 8) & 0xFF, 1]
 
-        # 组合包头和数据，并添加到结果列表
+        # 组合包头和数据，逐行交给调用方
         packet = bytes(row_bytes_data)
-        packets.append(packet)
-
-    return packets
+        yield packet
 
 
 ### 如何使用
@@ -0,0 +1,63 @@
+import asyncio
+import time
+from enum import IntEnum
+from typing import Dict, List
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+
+
+class JobScheduler:
+    """
+    Queue of print jobs ordered by priority class, then by fair share and
+    estimated size. Jobs need `priority`, `client` and `cost` (rows to print)
+    attributes.
+
+    Within a class each client is charged for the rows it has been served,
+    start-time fair queuing style: a client that starts submitting is
+    charged as much as the least served client still waiting, so nobody
+    banks credit while idle. The job with the lowest charge plus cost goes
+    first, which favours short jobs and clients that printed little. Waiting
+    lowers a job's score by `aging_rows_per_second` rows per second, and a
+    job waiting `promote_after` seconds moves up a class, so long and bulk
+    jobs still run under a steady stream of receipts.
+    """
+
+    def __init__(self, aging_rows_per_second: float = 20.0, promote_after: float = 120.0) -> None:
+        self._aging = aging_rows_per_second
+        self._promote_after = promote_after
+        self._jobs: List = []
+        self._enqueued_at: Dict[int, float] = {}
+        self._served: Dict[str, float] = {}
+        self._available = asyncio.Semaphore(0)
+
+    def qsize(self) -> int:
+        return len(self._jobs)
+
+    def put_nowait(self, job) -> None:
+        if job.client not in self._served:
+            waiting = [self._served[other.client] for other in self._jobs]
+            self._served[job.client] = min(waiting, default=0.0)
+        self._enqueued_at[id(job)] = time.monotonic()
+        self._jobs.append(job)
+        self._available.release()
+
+    async def get(self):
+        await self._available.acquire()
+        job = min(self._jobs, key=self._score)
+        self._jobs.remove(job)
+        del self._enqueued_at[id(job)]
+        self._served[job.client] += job.cost
+        # Clients with nothing queued are charged afresh when they return.
+        queued_clients = {other.client for other in self._jobs}
+        for client in [client for client in self._served if client not in queued_clients]:
+            del self._served[client]
+        return job
+
+    def _score(self, job):
+        waited = time.monotonic() - self._enqueued_at[id(job)]
+        priority = max(int(Priority.INTERACTIVE), int(job.priority) - int(waited // self._promote_after))
+        return (priority, self._served[job.client] + job.cost - waited * self._aging)
@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler
+from scheduler import JobScheduler, Priority
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock)
+    return clock
+
+
+def job(name, client="a", cost=100, priority=Priority.NORMAL):
+    return SimpleNamespace(name=name, client=client, cost=cost, priority=priority)
+
+
+def drain(queue: JobScheduler) -> list:
+    async def run():
+        return [(await queue.get()).name for _ in range(queue.qsize())]
+    return asyncio.run(run())
+
+
+def test_priority_classes_go_first(clock):
+    queue = JobScheduler()
+    queue.put_nowait(job("bulk", priority=Priority.BULK))
+    queue.put_nowait(job("normal", priority=Priority.NORMAL))
+    queue.put_nowait(job("receipt", priority=Priority.INTERACTIVE))
+    assert drain(queue) == ["receipt", "normal", "bulk"]
+
+
+def test_shorter_jobs_first_within_a_class(clock):
+    queue = JobScheduler()
+    queue.put_nowait(job("long", cost=5000))
+    queue.put_nowait(job("short", cost=50))
+    assert drain(queue) == ["short", "long"]
+
+
+def test_clients_take_turns(clock):
+    queue = JobScheduler()
+    for i in range(3):
+        queue.put_nowait(job(f"a{i}", client="a"))
+    # A client arriving later is charged like the least served waiting client.
+    queue.put_nowait(job("b0", client="b"))
+    queue.put_nowait(job("b1", client="b"))
+    assert drain(queue) == ["a0", "b0", "a1", "b1", "a2"]
+
+
+def test_aging_lets_a_long_job_overtake_new_short_ones(clock):
+    queue = JobScheduler(aging_rows_per_second=20.0, promote_after=1000.0)
+    queue.put_nowait(job("long", client="a", cost=1000))
+    clock.now += 30
+    queue.put_nowait(job("short", client="b", cost=500))
+    # The long job scores 1000 - 30 * 20 = 400, below the short job's 500.
+    assert drain(queue) == ["long", "short"]
+
+
+def test_waiting_job_is_promoted_a_class(clock):
+    queue = JobScheduler(aging_rows_per_second=0.0, promote_after=60.0)
+    queue.put_nowait(job("bulk", client="a", priority=Priority.BULK))
+    clock.now += 61
+    queue.put_nowait(job("normal", client="b", cost=1, priority=Priority.NORMAL))
+    queue.put_nowait(job("receipt", client="c", cost=1, priority=Priority.INTERACTIVE))
+    # After one period the bulk job competes as NORMAL, where the cheaper job
+    # still wins, but it no longer waits behind all NORMAL work.
+    assert drain(queue) == ["receipt", "normal", "bulk"]
+    queue.put_nowait(job("bulk", client="a", priority=Priority.BULK))
+    clock.now += 121
+    # After two periods it competes as INTERACTIVE.
+    queue.put_nowait(job("normal", client="b", cost=1, priority=Priority.NORMAL))
+    assert drain(queue) == ["bulk", "normal"]
@@ -1,37 +1,78 @@
 from printer import Printer
-from printer_data import PrinterData
+from printer_data import encode_image_segments
+from print_pipeline import PrintPipeline
+from transmission_stats import TransmissionStats
+import cv2
 import sys
+import time
+
+
+def send_images(image_paths, serial_port):
+    """
+    Prints several images as consecutive jobs. Each image is encoded while
+    the previous one is still being sent, so the printer does not idle.
+    """
+    printer = Printer(serial_port)
+    failed = False
+    with PrintPipeline(printer) as pipeline:
+        futures = []
+        for image_path in image_paths:
+            ok, frames = cv2.imreadmulti(image_path, flags=cv2.IMREAD_GRAYSCALE)
+            if not ok or not frames:
+                print(f"Image not found at {image_path}, skipping.")
+                failed = True
+                continue
+            futures.append((image_path, pipeline.submit(frames)))
+
+        for image_path, future in futures:
+            try:
+                print(f"{image_path} printed in {future.result():.2f}s!")
+            except Exception as e:
+                print(f"An error occurred while printing {image_path}: {e}")
+                failed = True
+    if failed:
+        sys.exit(1)
+
 
 def main():
     """
     Main function to send an image to the printer.
     """
     if len(sys.argv) < 3:
-        print("Usage: python send_image_to_printer.py <image_path> <serial_port>")
+        print("Usage: python send_image_to_printer.py <image_path> [<image_path> ...] <serial_port>")
         print("Example: python send_image_to_printer.py my_image.png /dev/rfcomm0")
         sys.exit(1)
 
+    if len(sys.argv) > 3:
+        send_images(sys.argv[1:-1], sys.argv[-1])
+        return
+
     image_path = sys.argv[1]
     serial_port = sys.argv[2]
 
     print(f"Processing image: {image_path}")
-    try:
-        printer_data = PrinterData.from_image(image_path, dithering=True)
-    except FileNotFoundError as e:
-        print(e)
-        sys.exit(1)
-    except Exception as e:
-        print(f"An error occurred during image processing: {e}")
+    ok, frames = cv2.imreadmulti(image_path, flags=cv2.IMREAD_GRAYSCALE)
+    if not ok or not frames:
+        print(f"Image not found at {image_path}")
         sys.exit(1)
+    # Multi-frame images (GIF, multi-page TIFF) are printed as one job.
+    if len(frames) > 1:
+        print(f"Image has {len(frames)} frames, printing them back to back.")
 
     print(f"Sending image to printer on port: {serial_port}")
 
     try:
         printer = Printer(serial_port)
-        printer.run(printer_data)
-        print("Image sent successfully!")
+        stats = TransmissionStats()
+        started = time.monotonic()
+        # Each sub-job is dithered only once the previous one has been sent,
+        # so a tall image is never held in memory as a whole.
+        for job in encode_image_segments(frames, dithering=True):
+            printer.send(job, stats=stats)
+        print(f"Image printed in {time.monotonic() - started:.2f}s!")
+        print(stats.format())
     except Exception as e:
-        print(f"An error occurred while sending data to the printer: {e}")
+        print(f"An error occurred while printing: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
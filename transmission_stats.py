@@ -0,0 +1,99 @@
+import bisect
+import time
+from typing import Optional
+
+# Upper bounds in seconds of the per-write latency histogram buckets.
+WRITE_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class TransmissionStats:
+    """
+    Instrumentation hooks for a transport. Printer and AsyncPrinter call them
+    while sending when a TransmissionStats is passed to run() or send(); all
+    times are relative to the start of the first job.
+    """
+
+    def __init__(self, buckets=WRITE_LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        # One count per bucket, plus one for writes slower than the last bound.
+        self.write_latency_counts = [0] * (len(self.buckets) + 1)
+        self.write_latency_sum = 0.0
+        self.writes = 0
+        self.bytes_sent = 0
+        self.rows_total = 0
+        self.rows_sent = 0
+        self._rows_base = 0
+        self.started_at: Optional[float] = None
+        self.first_row_at: Optional[float] = None
+        self.last_row_at: Optional[float] = None
+        self.end_response_at: Optional[float] = None
+        self.end_responses = 0
+
+    def on_job_start(self, rows: int) -> None:
+        """Called before the header of each (sub-)job is written."""
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        self._rows_base = self.rows_total
+        self.rows_total += rows
+
+    def on_write(self, nbytes: int, latency: float, rows_sent: int) -> None:
+        """
+        Called after each write with the bytes written, how long the write
+        took and how many rows of the current job are now completely sent.
+        """
+        self.writes += 1
+        self.bytes_sent += nbytes
+        self.write_latency_sum += latency
+        self.write_latency_counts[bisect.bisect_left(self.buckets, latency)] += 1
+
+        rows = self._rows_base + rows_sent
+        if rows > self.rows_sent:
+            now = time.monotonic()
+            if self.first_row_at is None:
+                self.first_row_at = now
+            self.rows_sent = rows
+            if rows == self.rows_total:
+                self.last_row_at = now
+
+    def on_end_response(self) -> None:
+        """Called when the printer confirms the end of each (sub-)job."""
+        self.end_response_at = time.monotonic()
+        self.end_responses += 1
+
+    def _since_start(self, at: Optional[float]) -> Optional[float]:
+        if at is None or self.started_at is None:
+            return None
+        return at - self.started_at
+
+    def summary(self) -> dict:
+        send_time = self._since_start(self.last_row_at)
+        return {
+            "bytes_sent": self.bytes_sent,
+            "rows_sent": self.rows_sent,
+            "writes": self.writes,
+            "bytes_per_second": self.bytes_sent / send_time if send_time else None,
+            "time_to_first_row": self._since_start(self.first_row_at),
+            "time_to_last_row": send_time,
+            "time_to_end_response": self._since_start(self.end_response_at),
+            "write_latency_sum": self.write_latency_sum,
+            "write_latency_buckets": dict(zip(
+                [str(bound) for bound in self.buckets] + ["+Inf"],
+                self.write_latency_counts,
+            )),
+        }
+
+    def format(self) -> str:
+        """One-line human readable summary for command line output."""
+        summary = self.summary()
+
+        def ms(value):
+            return "n/a" if value is None else f"{value * 1000:.1f}ms"
+
+        rate = summary["bytes_per_second"]
+        return (
+            f"{summary['rows_sent']} rows, {summary['bytes_sent']} bytes in {summary['writes']} writes"
+            f" ({'n/a' if rate is None else f'{rate / 1024:.1f} KiB/s'});"
+            f" first row {ms(summary['time_to_first_row'])},"
+            f" last row {ms(summary['time_to_last_row'])},"
+            f" end response {ms(summary['time_to_end_response'])}"
+        )
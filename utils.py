@@ -13,4 +13,29 @@ class ReserveLineException(Exception):
 
 class TooManyCharException(Exception):
     def __str__(self) -> str:
-        return "draw function can only accept a character one at a time."
\ No newline at end of file
+        return "draw function can only accept a character one at a time."
+
+class TooManyRowsException(Exception):
+    def __str__(self) -> str:
+        return "Job has more rows than the 16-bit row counter can address, split it with segments()."
+
+class PrinterDisconnectedException(Exception):
+    def __init__(self, port: str, reason: str = "") -> None:
+        super().__init__(port, reason)
+        self.port = port
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return f"Printer on {self.port} is not connected: {self.reason}"
+
+class PrintTimeoutException(Exception):
+    def __init__(self, timeout: float) -> None:
+        super().__init__(timeout)
+        self.timeout = timeout
+
+    def __str__(self) -> str:
+        return f"Printer did not report the end of the job within {self.timeout:.1f}s."
+
+class NoPrinterAvailableException(Exception):
+    def __str__(self) -> str:
+        return "Every printer in the pool is out of rotation."